@@ -3,12 +3,24 @@
 import asyncio
 import argparse
 import logging
+import os
+import stat
 import sys
+import time
 import aioutp
 
 keep_running = False
 logger = None
 listen_mode = False
+telemetry_file = None
+bulk = False
+
+# size of the reads from stdin and from the connection in bulk mode
+CHUNK_SIZE = 256 * 1024
+
+# how long to wait for libutp to finish closing the connection, in
+# seconds, before giving up on it
+CLOSE_TIMEOUT = 30
 
 async def read_stdin():
     loop = asyncio.get_event_loop()
@@ -25,11 +37,33 @@ async def read_stdin():
     finally:
         loop.remove_reader(0)
 
+async def read_stdin_chunk(size):
+    loop = asyncio.get_event_loop()
+    fd = sys.stdin.fileno()
+
+    if stat.S_ISREG(os.fstat(fd).st_mode):
+        # regular files can't be polled, and reading them doesn't block
+        # for long
+        return os.read(fd, size)
+
+    fut = loop.create_future()
+    def stdin_cb():
+        if fut.done():
+            return
+        try:
+            fut.set_result(os.read(fd, size))
+        except OSError as e:
+            fut.set_exception(e)
+
+    try:
+        loop.add_reader(fd, stdin_cb)
+        return await fut
+    finally:
+        loop.remove_reader(fd)
+
 async def ucat(reader, writer):
     global keep_running
 
-    loop = asyncio.get_event_loop()
-
     line_reader = None
     result = None
     while keep_running:
@@ -73,10 +107,89 @@ async def ucat(reader, writer):
         except (asyncio.CancelledError, asyncio.TimeoutError):
             pass
 
-    if not writer._transport.is_closing() and \
-       not writer._transport.closed.is_set():
+    await finish(writer)
+
+async def bulk_ucat(reader, writer):
+    # Stream stdin to the connection and the connection to stdout, as
+    # raw bytes and in large chunks, until the peer closes the
+    # connection or we are done sending.
+    out = sys.stdout.buffer
+    sent = 0
+    received = 0
+
+    async def send():
+        nonlocal sent
+        while True:
+            data = await read_stdin_chunk(CHUNK_SIZE)
+            if not data:
+                break
+            writer.write(data)
+            sent += len(data)
+            await writer.drain()
+        if sent:
+            # the transport flushes what's left before closing; a side
+            # that had nothing to send keeps receiving
+            writer.close()
+
+    async def receive():
+        nonlocal received
+        while True:
+            data = await reader.read(CHUNK_SIZE)
+            if not data:
+                break
+            out.write(data)
+            received += len(data)
+
+    start = time.monotonic()
+    send_task = asyncio.ensure_future(send())
+    receive_task = asyncio.ensure_future(receive())
+    try:
+        while keep_running and not receive_task.done():
+            # the timeout gives Ctrl-C a chance to break the loop
+            await asyncio.wait([receive_task], timeout=0.1)
+        if send_task.done():
+            send_task.result()
+        if receive_task.done():
+            receive_task.result()
+    except Exception as e:
+        logger.error('Transfer failed: {}'.format(e))
+    finally:
+        for t in (send_task, receive_task):
+            if not t.done():
+                t.cancel()
+                try:
+                    await t
+                except asyncio.CancelledError:
+                    pass
+    elapsed = time.monotonic() - start
+
+    out.flush()
+    print('Sent {} bytes, received {} bytes in {:.3f}s ({:.2f} MiB/s)'.format(
+        sent, received, elapsed,
+        max(sent, received) / 2**20 / elapsed if elapsed else 0),
+          file=sys.stderr)
+
+    await finish(writer)
+
+async def finish(writer):
+    loop = asyncio.get_event_loop()
+
+    if telemetry_file:
+        with open(telemetry_file, 'w') as f:
+            writer.transport.telemetry.dump(f)
+
+    if not writer.transport.is_closing() and \
+       not writer.transport.closed.is_set():
         writer.close()
 
+    # libutp may still be retransmitting unacknowledged data and the
+    # FIN; stopping the loop now would cut the transfer short
+    try:
+        await asyncio.wait_for(writer.transport.wait_closed(), CLOSE_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning('Connection did not close within {}s.'.format(
+            CLOSE_TIMEOUT))
+
     loop.stop()
 
 async def run(loop, args):
@@ -90,24 +203,25 @@ async def run(loop, args):
             writer.close()
             return
 
-        host, port = reader._transport.get_extra_info('sockname')
+        host, port = writer.get_extra_info('peername')
         logger.info('Accepted connection from {}:{}'.format(host, port))
 
         accepted = True
-        await ucat(reader, writer)
+        await (bulk_ucat if bulk else ucat)(reader, writer)
 
     if listen_mode:
         server = await aioutp.start_server(connected_cb,
                                            args.bind_address, args.listen,
-                                           debug=args.debug)
+                                           debug=args.debug,
+                                           telemetry=bool(args.telemetry))
     else:
         reader, writer = await aioutp.open_connection(
             args.dest_host, args.dest_port,
-            debug=args.debug)
-        await ucat(reader, writer)
+            debug=args.debug, telemetry=bool(args.telemetry))
+        await (bulk_ucat if bulk else ucat)(reader, writer)
 
 def main():
-    global keep_running, logger, listen_mode
+    global keep_running, logger, listen_mode, telemetry_file, bulk
 
     parser = argparse.ArgumentParser(
         description='netcat-like utility using uTP as the transport protocol.')
@@ -133,6 +247,15 @@ def main():
         help='Minimum level of the logged messages.')
     parser.add_argument('--log-to-stdout', '-o', action='store_true',
                         help='Write log messages to standard output.')
+    parser.add_argument('--telemetry', '-t', metavar='FILE',
+                        help='Record congestion telemetry and write it to '
+                        'the given file when done. Use utpstat.py to '
+                        'summarize it.')
+    parser.add_argument('--bulk', '-B', action='store_true',
+                        help='Bulk transfer mode: stream standard input '
+                        'in large chunks, write received data to standard '
+                        'output as-is, and report the throughput on '
+                        'standard error when done.')
 
     args = parser.parse_args()
 
@@ -149,6 +272,9 @@ def main():
     if args.listen:
         listen_mode = True
 
+    telemetry_file = args.telemetry
+    bulk = args.bulk
+
     if args.debug:
         args.log_level = 'debug'
 
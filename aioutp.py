@@ -1,76 +1,974 @@
 import asyncio
+import errno
+import itertools
+import os
 import socket
+import struct
+import sys
 import logging
+import time
+import ctypes
 import utp
-from collections import deque
+import utplog
+from collections import deque, namedtuple
+
+# Large enough for any UDP datagram. A peer may send datagrams as large
+# as its own path MTU, and a shorter buffer would cut them short
+# without an error, which libutp can't detect.
+RECV_BUF_SIZE = 65536
+
+def recv_buffer(size):
+    # A receive buffer that is allocated once and reused for every
+    # datagram, and a ctypes view of it that can be passed to
+    # utp_process_udp without copying.
+    buf = bytearray(size)
+    return buf, (ctypes.c_char * size).from_buffer(buf)
+
+class LoopClock:
+    """A libutp time source that follows the event loop's clock. The
+    time is cached and only refreshed once per batch of I/O, so that
+    libutp asking for the time over and over again costs as little as
+    possible."""
+
+    def __init__(self, loop):
+        self._loop = loop
+        self.refresh()
+
+    def refresh(self):
+        now = self._loop.time()
+        self.ms = int(now * 1000)
+        self.us = int(now * 1000000)
+
+    def milliseconds(self, cb, ctx, sock):
+        return self.ms
+
+    def microseconds(self, cb, ctx, sock):
+        return self.us
+
+class VirtualClock:
+    """A libutp time source that only moves when advance is called,
+    for simulations and deterministic tests. Transports and servers
+    using the clock run their timeout checks after every advance, so
+    retransmissions and timeouts fire without waiting in real time."""
+
+    def __init__(self, start=0):
+        self.us = int(start * 1000000)
+        self.__hooks = []
+
+    def refresh(self):
+        pass
+
+    def add_hook(self, func):
+        """Call func with no arguments after every advance."""
+        self.__hooks.append(func)
+
+    def remove_hook(self, func):
+        if func in self.__hooks:
+            self.__hooks.remove(func)
+
+    def advance(self, seconds):
+        self.us += int(seconds * 1000000)
+        for func in list(self.__hooks):
+            func()
+
+    def milliseconds(self, cb, ctx, sock):
+        return self.us // 1000
+
+    def microseconds(self, cb, ctx, sock):
+        return self.us
+
+def make_clock(loop, time_source):
+    # time_source is None for libutp's own clock, 'loop' for a
+    # LoopClock, or a clock object.
+    if time_source is None:
+        return None
+    if time_source == 'loop':
+        return LoopClock(loop)
+    return time_source
+
+def set_clock_callbacks(ctx, clock):
+    if clock is not None:
+        utp.utp_set_callback(ctx, utp.UTP_GET_MILLISECONDS, clock.milliseconds)
+        utp.utp_set_callback(ctx, utp.UTP_GET_MICROSECONDS, clock.microseconds)
+
+def add_clock_hook(clock, func):
+    if hasattr(clock, 'add_hook'):
+        clock.add_hook(func)
+
+def remove_clock_hook(clock, func):
+    if hasattr(clock, 'remove_hook'):
+        clock.remove_hook(func)
+
+ALL_LOG_OPTIONS = (utp.UTP_LOG_NORMAL, utp.UTP_LOG_MTU, utp.UTP_LOG_DEBUG)
+
+def set_log_options(ctx, debug, log_options):
+    # debug enables all of libutp's logs; log_options can be used to
+    # enable only some of them, e.g. (UTP_LOG_NORMAL, UTP_LOG_MTU).
+    if debug:
+        log_options = ALL_LOG_OPTIONS
+    for option in log_options or ():
+        utp.utp_context_set_option(ctx, option, 1)
+
+def set_log_callback(ctx, logger, buffered_log, log_cb):
+    # Returns the BufferedLogHandler in use, if any.
+    if buffered_log:
+        handler = utplog.BufferedLogHandler(logger)
+        utp.utp_set_callback(ctx, utp.UTP_LOG, handler, raw=True)
+        return handler
+    utp.utp_set_callback(ctx, utp.UTP_LOG, log_cb, raw=True)
+    return None
+
+TelemetryRecord = namedtuple('TelemetryRecord', 'time kind value')
+
+# telemetry record kinds
+DELAY_SAMPLE = 'delay'
+BYTES_SENT = 'sent'
+RETRANSMIT = 'retransmit'
+
+class Telemetry:
+    """A ring buffer of per-connection congestion telemetry: delay
+    samples (in milliseconds), the size of each datagram sent and the
+    number of bytes retransmitted. Iterating over it asynchronously
+    yields records as they arrive."""
+
+    def __init__(self, loop, size=4096):
+        self._loop = loop
+        self.records = deque(maxlen=size)
+        self.count = 0
+        self.__waiters = []
+
+    def add(self, kind, value):
+        self.records.append(TelemetryRecord(self._loop.time(), kind, value))
+        self.count += 1
+        if self.__waiters:
+            for waiter in self.__waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+            self.__waiters = []
+
+    async def __aiter__(self):
+        seen = self.count
+        while True:
+            if seen == self.count:
+                waiter = self._loop.create_future()
+                self.__waiters.append(waiter)
+                await waiter
+            # records that have fallen off the ring buffer are skipped
+            new = min(self.count - seen, len(self.records))
+            seen = self.count
+            for record in list(self.records)[-new:]:
+                yield record
+
+    def dump(self, f):
+        """Write the records in the buffer to the given file object, one
+        per line, in the format utpstat.py reads."""
+        for record in self.records:
+            f.write('{:.6f} {} {}\n'.format(*record))
+
+# socket options missing from the socket module on some Python versions
+IP_MTU = getattr(socket, 'IP_MTU', 14)
+IP_MTU_DISCOVER = getattr(socket, 'IP_MTU_DISCOVER', 10)
+IP_PMTUDISC_DO = getattr(socket, 'IP_PMTUDISC_DO', 2)
+
+UDP_IPV4_OVERHEAD = 28
+DEFAULT_MTU = 1500
+MAX_MTU = 65535
+
+class PathMtuCache:
+    """Path MTUs to the peers of a context, as the kernel knows them,
+    for the UTP_GET_UDP_MTU and UTP_GET_UDP_OVERHEAD callbacks.
+    tunnel_overhead is subtracted from every path MTU, for links that
+    wrap our packets in something the kernel doesn't know about."""
+
+    def __init__(self, tunnel_overhead=0, ttl=600):
+        self.tunnel_overhead = tunnel_overhead
+        self.ttl = ttl
+        self.__mtus = {}
+
+    def path_mtu(self, host):
+        now = time.monotonic()
+        entry = self.__mtus.get(host)
+        if entry is not None and entry[1] > now:
+            return entry[0]
+
+        # IP_MTU is only available on connected sockets, so ask the
+        # kernel through a throwaway one.
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            s.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_DO)
+            s.connect((host, 9))
+            mtu = min(s.getsockopt(socket.IPPROTO_IP, IP_MTU), MAX_MTU)
+        except OSError:
+            mtu = DEFAULT_MTU
+        finally:
+            s.close()
+
+        self.__mtus[host] = (mtu, now + self.ttl)
+        return mtu
+
+    def forget(self, host):
+        self.__mtus.pop(host, None)
+
+    def udp_mtu_cb(self, cb, ctx, sock, addr):
+        return (self.path_mtu(addr[0]) - UDP_IPV4_OVERHEAD -
+                self.tunnel_overhead)
+
+    def udp_overhead_cb(self, cb, ctx, sock, addr):
+        return UDP_IPV4_OVERHEAD + self.tunnel_overhead
+
+    def set_callbacks(self, ctx):
+        utp.utp_set_callback(ctx, utp.UTP_GET_UDP_MTU, self.udp_mtu_cb)
+        utp.utp_set_callback(ctx, utp.UTP_GET_UDP_OVERHEAD,
+                             self.udp_overhead_cb)
+
+    def prepare_socket(self, sock):
+        # Have the kernel refuse to fragment our datagrams, so that
+        # libutp's MTU probes work and the kernel learns the path MTU.
+        sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_DO)
+
+# Linux UDP segmentation offload (GSO) and receive offload (GRO)
+SOL_UDP = getattr(socket, 'SOL_UDP', 17)
+UDP_SEGMENT = getattr(socket, 'UDP_SEGMENT', 103)
+UDP_GRO = getattr(socket, 'UDP_GRO', 104)
+
+# at most this many segments, and this many bytes, in one GSO send
+GSO_MAX_SEGMENTS = 64
+GSO_MAX_SIZE = 65000
+
+def enable_gso(sock):
+    # There is nothing to enable: the segment size is passed with every
+    # send. Just check that the kernel knows about the option.
+    try:
+        sock.getsockopt(SOL_UDP, UDP_SEGMENT)
+    except OSError:
+        return False
+    return True
+
+def enable_gro(sock):
+    try:
+        sock.setsockopt(SOL_UDP, UDP_GRO, 1)
+    except OSError:
+        return False
+    return True
+
+SO_RCVBUFFORCE = getattr(socket, 'SO_RCVBUFFORCE', 33)
+SO_SNDBUFFORCE = getattr(socket, 'SO_SNDBUFFORCE', 32)
+SO_RXQ_OVFL = getattr(socket, 'SO_RXQ_OVFL', 40)
+
+def set_buffer_size(sock, option, force_option, size):
+    # The FORCE variants can go over net.core.[rw]mem_max, but need
+    # CAP_NET_ADMIN. Returns the size the kernel actually uses (which
+    # is double what was asked for, on Linux).
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, force_option, size)
+    except OSError:
+        sock.setsockopt(socket.SOL_SOCKET, option, size)
+    return sock.getsockopt(socket.SOL_SOCKET, option)
+
+def enable_drop_stats(sock):
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+    except OSError:
+        return False
+    return True
+
+# the destination address of each received datagram, for sockets bound
+# to the wildcard address
+IP_PKTINFO = getattr(socket, 'IP_PKTINFO', 8)
+# sizeof(struct in_pktinfo)
+IN_PKTINFO_SIZE = 12
+
+def enable_pktinfo(sock):
+    if sock.getsockname()[0] != '0.0.0.0':
+        return False
+    try:
+        sock.setsockopt(socket.IPPROTO_IP, IP_PKTINFO, 1)
+    except OSError:
+        return False
+    return True
+
+# bytes each flow of a FairQueue may send per round, times its weight
+FAIR_QUANTUM = 1500
+
+class FairQueue:
+    """Deficit round robin over per-flow queues of datagrams. Every
+    round, each flow with datagrams queued may send FAIR_QUANTUM bytes
+    times its weight, so when the socket can't keep up, flows get the
+    send bandwidth in proportion to their weights instead of in the
+    order they queued datagrams."""
+
+    def __init__(self, quantum=FAIR_QUANTUM):
+        self.quantum = quantum
+        # flow -> [queue of (size, item), deficit, weight]
+        self.__flows = {}
+        # flows with datagrams queued, in round robin order
+        self.__active = deque()
+
+    def __bool__(self):
+        return bool(self.__active)
+
+    def push(self, flow, item, size, weight=1):
+        if not weight > 0:
+            raise ValueError('weight must be > 0, not {}'.format(weight))
+        f = self.__flows.get(flow)
+        if f is None:
+            f = self.__flows[flow] = [deque(), 0, weight]
+            self.__active.append(flow)
+        else:
+            f[2] = weight
+        f[0].append((size, item))
+
+    def pop_round(self, out):
+        """Append the datagrams of one round to out, returning how many
+        there were."""
+        flows = self.__flows
+        active = self.__active
+        moved = 0
+        while active and not moved:
+            for i in range(len(active)):
+                flow = active.popleft()
+                f = flows[flow]
+                queue = f[0]
+                f[1] += self.quantum * f[2]
+                while queue and queue[0][0] <= f[1]:
+                    size, item = queue.popleft()
+                    f[1] -= size
+                    out.append(item)
+                    moved += 1
+                if queue:
+                    active.append(flow)
+                else:
+                    # an idle flow doesn't keep its deficit
+                    del flows[flow]
+        return moved
+
+class TokenBucket:
+    """A token bucket for rate limiting: rate bytes per second, with
+    bursts of up to burst bytes (by default, 50 ms worth but at least
+    16 KiB). Tokens are refilled lazily from the loop's clock, so
+    nothing runs while the bucket is idle."""
+
+    def __init__(self, loop, rate, burst=None):
+        self._loop = loop
+        if burst is None:
+            burst = max(int(rate * 0.05), 16 * 1024)
+        self.__check(rate, burst)
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.__last = loop.time()
+
+    @staticmethod
+    def __check(rate, burst):
+        if not rate > 0:
+            raise ValueError('rate must be > 0, not {}'.format(rate))
+        if burst is not None and not burst > 0:
+            raise ValueError('burst must be > 0, not {}'.format(burst))
+
+    def set_rate(self, rate, burst=None):
+        """Change the rate, and the burst size if one is given."""
+        self.__check(rate, burst)
+        # the tokens so far accrued at the old rate
+        self.__refill()
+        self.rate = rate
+        if burst is not None:
+            self.burst = burst
+            self.tokens = min(self.tokens, burst)
+
+    def __refill(self):
+        now = self._loop.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.__last) * self.rate)
+        self.__last = now
+
+    def consume(self, n):
+        """Take n tokens if they are available, returning whether they
+        were. Anything larger than the burst size goes through on a
+        full bucket and leaves it in debt."""
+        self.__refill()
+        if self.tokens < min(n, self.burst):
+            return False
+        self.tokens -= n
+        return True
+
+    def take(self, n):
+        """Take up to n tokens, returning how many were taken."""
+        self.__refill()
+        n = min(n, int(self.tokens))
+        if n <= 0:
+            return 0
+        self.tokens -= n
+        return n
+
+    def refund(self, n):
+        self.tokens = min(self.burst, self.tokens + n)
+
+    def delay(self, n):
+        """How long until consume(n) would succeed, in seconds."""
+        self.__refill()
+        return max(min(n, self.burst) - self.tokens, 0) / self.rate
+
+class UdpEndpoint:
+    """A non-blocking UDP socket registered with the event loop. It
+    feeds the datagrams it receives to a utp context and sends the ones
+    the context gives it.
+
+    With offload=True, consecutive datagrams of the same size to the
+    same peer are sent with one GSO send, and coalesced datagrams are
+    received with GRO and split again before being passed to libutp,
+    if the kernel supports it.
+
+    rcvbuf and sndbuf set the socket's kernel buffer sizes. With
+    drop_stats=True, kernel_drops is kept up to date with the number of
+    datagrams the kernel dropped because the receive buffer was full
+    (where SO_RXQ_OVFL is supported; it stays None otherwise).
+
+    When several endpoints share a context, they are given the same
+    routes dict, in which each one records itself as the route to every
+    peer it receives from.
+
+    local_addr is the local address the last datagram was sent to. For
+    a socket bound to 0.0.0.0 it comes from IP_PKTINFO, so it is the
+    address the peer actually reached; otherwise it is the address the
+    socket is bound to. (Replies still leave from whichever address the
+    kernel picks for the route back.)
+
+    While a server hands its sockets over to another process, forwarder
+    is set to the HandoffForwarder that datagrams belonging to the other
+    process are passed to instead of the context.
+
+    With fair_queue=True, datagrams waiting for the socket are
+    scheduled with a FairQueue over the flows passed to send, instead
+    of being sent in order. rate_limiter, a TokenBucket that can be
+    shared between endpoints, paces the datagrams sent; GSO is not used
+    while pacing."""
+
+    def __init__(self, loop, sock, ctx, on_error, clock=None,
+                 mtu_cache=None, offload=False, rcvbuf=None, sndbuf=None,
+                 drop_stats=False, routes=None, fair_queue=False,
+                 rate_limiter=None):
+        self._loop = loop
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.ctx = ctx
+        self.__on_error = on_error
+        self.__clock = clock
+        self.__mtu_cache = mtu_cache
+        self.__reading = False
+        self.__writing = False
+        self.__send_buf = deque()
+        self.__fair_queue = FairQueue() if fair_queue else None
+        self.__rate_limiter = rate_limiter
+        self.__pacing_timer = None
+        self.__routes = routes
+        self.gso = offload and enable_gso(sock)
+        self.gro = offload and enable_gro(sock)
+        self.kernel_drops = None
+        self.local_addr = sock.getsockname()
+        self.__pktinfo = enable_pktinfo(sock)
+        self.forwarder = None
+
+        if rcvbuf is not None:
+            set_buffer_size(sock, socket.SO_RCVBUF, SO_RCVBUFFORCE, rcvbuf)
+        if sndbuf is not None:
+            set_buffer_size(sock, socket.SO_SNDBUF, SO_SNDBUFFORCE, sndbuf)
+        if drop_stats and enable_drop_stats(sock):
+            self.kernel_drops = 0
+
+        if mtu_cache is not None:
+            mtu_cache.prepare_socket(sock)
+        self.__recv_buf, self.__recv_cbuf = recv_buffer(RECV_BUF_SIZE)
+
+    def start_reading(self):
+        if not self.__reading:
+            if self.gro or self.kernel_drops is not None or self.__pktinfo:
+                self._loop.add_reader(self.fd, self.__read_udp_msg)
+            else:
+                self._loop.add_reader(self.fd, self.__read_udp)
+            self.__reading = True
+
+    def stop_reading(self):
+        if self.__reading:
+            self._loop.remove_reader(self.fd)
+            self.__reading = False
+
+    def send(self, data, addr, flow=None, weight=1):
+        if self.__fair_queue is None:
+            self.__send_buf.append((data, addr))
+        else:
+            self.__fair_queue.push(flow, (data, addr), len(data), weight)
+        if not self.__writing and self.__pacing_timer is None:
+            self._loop.add_writer(self.fd, self.__write_udp)
+            self.__writing = True
+
+    def __pace(self, delay):
+        # stop writing until the rate limiter has tokens again
+        self._loop.remove_writer(self.fd)
+        self.__writing = False
+        self.__pacing_timer = self._loop.call_later(delay, self.__resume)
+
+    def __resume(self):
+        self.__pacing_timer = None
+        if not self.__writing:
+            self._loop.add_writer(self.fd, self.__write_udp)
+            self.__writing = True
+
+    def __read_udp(self):
+        if self.__clock is not None:
+            self.__clock.refresh()
+
+        recvfrom_into = self.sock.recvfrom_into
+        process_udp = utp.utp_process_udp
+        ctx = self.ctx
+        routes = self.__routes
+        buf = self.__recv_buf
+        cbuf = self.__recv_cbuf
+        forwarder = self.forwarder
+        while True:
+            try:
+                n, addr = recvfrom_into(buf)
+            except socket.error as e:
+                if e.errno == socket.EAGAIN or e.errno == socket.EWOULDBLOCK:
+                    utp.utp_issue_deferred_acks(ctx)
+                else:
+                    self.__on_error(e)
+                return
+            if forwarder is not None and forwarder.forwards(addr):
+                forwarder.forward(self, memoryview(buf)[:n], addr)
+                continue
+            if routes is not None:
+                routes[addr] = self
+            process_udp(ctx, cbuf, addr, n)
+
+    def __read_udp_msg(self):
+        # Like __read_udp, but with recvmsg, for the ancillary data that
+        # comes with GRO, SO_RXQ_OVFL and IP_PKTINFO.
+        if self.__clock is not None:
+            self.__clock.refresh()
+
+        recvmsg_into = self.sock.recvmsg_into
+        process_udp = utp.utp_process_udp
+        ctx = self.ctx
+        routes = self.__routes
+        buf = self.__recv_buf
+        bufs = [buf]
+        cbuf = self.__recv_cbuf
+        ancbufsize = socket.CMSG_SPACE(4) * 2 + \
+            socket.CMSG_SPACE(IN_PKTINFO_SIZE)
+        port = self.local_addr[1]
+        local_host = None
+        forwarder = self.forwarder
+        while True:
+            try:
+                n, ancdata, flags, addr = recvmsg_into(bufs, ancbufsize)
+            except socket.error as e:
+                if e.errno == socket.EAGAIN or e.errno == socket.EWOULDBLOCK:
+                    utp.utp_issue_deferred_acks(ctx)
+                else:
+                    self.__on_error(e)
+                return
+
+            segment_size = 0
+            for level, type, data in ancdata:
+                if level == SOL_UDP and type == UDP_GRO:
+                    segment_size = int.from_bytes(data[:4], sys.byteorder)
+                elif level == socket.SOL_SOCKET and type == SO_RXQ_OVFL:
+                    # the total number of drops so far
+                    self.kernel_drops = int.from_bytes(data[:4],
+                                                       sys.byteorder)
+                elif level == socket.IPPROTO_IP and type == IP_PKTINFO:
+                    # ipi_addr, the destination address in the header
+                    if data[8:12] != local_host:
+                        local_host = data[8:12]
+                        self.local_addr = (socket.inet_ntoa(local_host),
+                                           port)
+            if forwarder is not None and forwarder.forwards(addr):
+                view = memoryview(buf)
+                step = segment_size or n
+                for offset in range(0, n, step):
+                    forwarder.forward(self, view[offset:min(offset + step, n)],
+                                      addr)
+                continue
+            if routes is not None:
+                routes[addr] = self
+            if segment_size == 0 or segment_size >= n:
+                process_udp(ctx, cbuf, addr, n)
+                continue
+
+            for offset in range(0, n, segment_size):
+                length = min(segment_size, n - offset)
+                segment = (ctypes.c_char * length).from_buffer(buf, offset)
+                process_udp(ctx, segment, addr, length)
+
+    def __write_udp(self):
+        send_buf = self.__send_buf
+        fair_queue = self.__fair_queue
+        rate_limiter = self.__rate_limiter
+        # with a fair queue, send_buf only holds the current round
+        while len(send_buf) != 0 or \
+              (fair_queue and fair_queue.pop_round(send_buf)):
+            data, peer = send_buf[0]
+            if rate_limiter is not None and \
+               not rate_limiter.consume(len(data)):
+                self.__pace(rate_limiter.delay(len(data)))
+                return
+            try:
+                if self.gso and rate_limiter is None and len(send_buf) > 1:
+                    sent = self.__send_segments(data, peer)
+                else:
+                    sent = self.sock.sendto(data, peer)
+                    send_buf.popleft()
+            except (BlockingIOError, InterruptedError):
+                # try again when the socket becomes writable
+                if rate_limiter is not None:
+                    rate_limiter.refund(len(data))
+                return
+            except OSError as e:
+                if e.errno != errno.EMSGSIZE or self.__mtu_cache is None:
+                    raise
+                # The path MTU has shrunk (or this was an MTU probe that
+                # was too large). Drop the datagram as if it was lost
+                # and look the MTU up again next time.
+                send_buf.popleft()
+                self.__mtu_cache.forget(peer[0])
+                continue
+            if sent < len(data):
+                raise RuntimeError('Could not send datagram.')
+
+        self._loop.remove_writer(self.fd)
+        self.__writing = False
+
+    def __send_segments(self, data, peer):
+        # Send data, along with the datagrams following it in the queue
+        # that go to the same peer and have the same size, in one GSO
+        # send. The last one is allowed to be shorter. Returns the size
+        # of the first datagram, for the caller's sanity check.
+        send_buf = self.__send_buf
+        size = len(data)
+        segments = [data]
+        total = size
+        for next_data, next_peer in itertools.islice(send_buf, 1, None):
+            if next_peer != peer or len(next_data) > size or \
+               len(segments) == GSO_MAX_SEGMENTS or \
+               total + len(next_data) > GSO_MAX_SIZE:
+                break
+            segments.append(next_data)
+            total += len(next_data)
+            if len(next_data) < size:
+                break
+
+        if len(segments) == 1:
+            sent = self.sock.sendto(data, peer)
+            send_buf.popleft()
+            return sent
+
+        try:
+            sent = self.sock.sendmsg(
+                segments, [(SOL_UDP, UDP_SEGMENT, struct.pack('H', size))],
+                0, peer)
+        except OSError as e:
+            if e.errno not in (errno.EIO, errno.EINVAL, errno.ENOPROTOOPT):
+                raise
+            # The kernel or the device can't do it after all (EIO is
+            # what we get when the device has no checksum offload).
+            self.gso = False
+            sent = self.sock.sendto(data, peer)
+            send_buf.popleft()
+            return sent
+
+        if sent < total:
+            raise RuntimeError('Could not send datagram.')
+        for i in range(len(segments)):
+            send_buf.popleft()
+        return size
+
+    def close(self):
+        self.stop_reading()
+        if self.__writing:
+            self._loop.remove_writer(self.fd)
+            self.__writing = False
+        if self.__pacing_timer is not None:
+            self.__pacing_timer.cancel()
+            self.__pacing_timer = None
+        self.sock.close()
+
+def check_io_mode(io_mode, offload=False, drop_stats=False,
+                  fair_queue=False):
+    # Raise ValueError for an unknown I/O mode or for options it can't
+    # honour, before anything has been set up.
+    if io_mode not in ('reader', 'datagram'):
+        raise ValueError('Unknown I/O mode: {}'.format(io_mode))
+    if io_mode == 'datagram':
+        for name, value in (('offload', offload),
+                            ('drop_stats', drop_stats),
+                            ('fair_queue', fair_queue)):
+            if value:
+                raise ValueError('{} is not available in the datagram I/O '
+                                 'mode.'.format(name))
+
+class DatagramEndpoint(asyncio.DatagramProtocol):
+    """The same thing as UdpEndpoint, built on
+    loop.create_datagram_endpoint instead of add_reader/add_writer, for
+    event loops where that is the faster (or the only) option. Offload
+    and drop_stats need recvmsg/sendmsg, and fair_queue needs control
+    over the order datagrams are sent in, which the loop's transport
+    keeps to itself, so they are not available here; asking for them
+    raises ValueError. gso and gro are always False and kernel_drops
+    None."""
+
+    def __init__(self, loop, sock, ctx, on_error, clock=None,
+                 mtu_cache=None, offload=False, rcvbuf=None, sndbuf=None,
+                 drop_stats=False, routes=None, fair_queue=False,
+                 rate_limiter=None):
+        check_io_mode('datagram', offload, drop_stats, fair_queue)
+        self._loop = loop
+        self.__rate_limiter = rate_limiter
+        self.__pacing_timer = None
+        self.sock = sock
+        self.ctx = ctx
+        self.__on_error = on_error
+        self.__clock = clock
+        self.__routes = routes
+        self.__transport = None
+        self.__reading = False
+        self.__acks_pending = False
+        # datagrams sent before the endpoint is ready
+        self.__send_buf = deque()
+        self.gso = False
+        self.gro = False
+        self.kernel_drops = None
+        # without recvmsg there is no IP_PKTINFO, so for a socket bound
+        # to 0.0.0.0 this stays the wildcard address
+        self.local_addr = sock.getsockname()
+        self.forwarder = None
+
+        if rcvbuf is not None:
+            set_buffer_size(sock, socket.SO_RCVBUF, SO_RCVBUFFORCE, rcvbuf)
+        if sndbuf is not None:
+            set_buffer_size(sock, socket.SO_SNDBUF, SO_SNDBUFFORCE, sndbuf)
+        if mtu_cache is not None:
+            mtu_cache.prepare_socket(sock)
+
+        self.__task = loop.create_task(
+            loop.create_datagram_endpoint(lambda: self, sock=sock))
+
+    def connection_made(self, transport):
+        self.__transport = transport
+        if not self.__reading:
+            self.__pause(transport)
+        self.__send_pending()
+
+    def __send_pending(self):
+        self.__pacing_timer = None
+        send_buf = self.__send_buf
+        rate_limiter = self.__rate_limiter
+        while send_buf:
+            data, addr = send_buf[0]
+            if rate_limiter is not None and \
+               not rate_limiter.consume(len(data)):
+                self.__pacing_timer = self._loop.call_later(
+                    rate_limiter.delay(len(data)), self.__send_pending)
+                return
+            self.__transport.sendto(data, addr)
+            send_buf.popleft()
+
+    def __pause(self, transport):
+        pause_reading = getattr(transport, 'pause_reading', None)
+        if pause_reading is not None:
+            pause_reading()
+
+    def start_reading(self):
+        if not self.__reading:
+            self.__reading = True
+            resume_reading = getattr(self.__transport, 'resume_reading', None)
+            if resume_reading is not None:
+                resume_reading()
+
+    def stop_reading(self):
+        if self.__reading:
+            self.__reading = False
+            if self.__transport is not None:
+                self.__pause(self.__transport)
+
+    def send(self, data, addr, flow=None, weight=1):
+        if self.__transport is None or self.__send_buf:
+            self.__send_buf.append((data, addr))
+        elif self.__rate_limiter is not None and \
+             not self.__rate_limiter.consume(len(data)):
+            self.__send_buf.append((data, addr))
+            self.__pacing_timer = self._loop.call_later(
+                self.__rate_limiter.delay(len(data)), self.__send_pending)
+        else:
+            self.__transport.sendto(data, addr)
+
+    def datagram_received(self, data, addr):
+        if not self.__reading:
+            # the loop can't pause this transport; drop it as the
+            # kernel would with a full buffer
+            return
+        forwarder = self.forwarder
+        if forwarder is not None and forwarder.forwards(addr):
+            forwarder.forward(self, data, addr)
+            return
+        if self.__clock is not None:
+            self.__clock.refresh()
+        if self.__routes is not None:
+            self.__routes[addr] = self
+        utp.utp_process_udp(self.ctx, data, addr)
+        if not self.__acks_pending:
+            # once for all the datagrams received in this iteration
+            self.__acks_pending = True
+            self._loop.call_soon(self.__issue_deferred_acks)
+
+    def __issue_deferred_acks(self):
+        self.__acks_pending = False
+        if self.ctx is not None:
+            utp.utp_issue_deferred_acks(self.ctx)
+
+    def error_received(self, exc):
+        if isinstance(exc, OSError) and exc.errno == errno.EMSGSIZE:
+            # too large for the path MTU; the same as a lost datagram
+            return
+        self.__on_error(exc)
+
+    def close(self):
+        self.__reading = False
+        self.ctx = None
+        if self.__pacing_timer is not None:
+            self.__pacing_timer.cancel()
+            self.__pacing_timer = None
+        if self.__transport is not None:
+            self.__transport.close()
+        else:
+            self.__task.cancel()
+            self.sock.close()
+
+def make_endpoint(io_mode, *args, **kwargs):
+    # io_mode is 'reader' (add_reader/add_writer on the socket) or
+    # 'datagram' (loop.create_datagram_endpoint).
+    if io_mode == 'reader':
+        return UdpEndpoint(*args, **kwargs)
+    elif io_mode == 'datagram':
+        return DatagramEndpoint(*args, **kwargs)
+    raise ValueError('Unknown I/O mode: {}'.format(io_mode))
 
 class UtpTransport(asyncio.Transport):
     def __init__(self, loop, protocol, host, port, local_addr=None,
-                 sock=None, ctx=None, server=None, debug=False):
+                 sock=None, ctx=None, server=None, debug=False,
+                 capture=None, time_source=None, telemetry=False,
+                 log_options=None, buffered_log=False, path_mtu=False,
+                 tunnel_overhead=0, offload=False, rcvbuf=None,
+                 sndbuf=None, drop_stats=False, io_mode='reader', weight=1,
+                 rate_limit=None, rate_burst=None):
+        if sock is None:
+            check_io_mode(io_mode, offload, drop_stats)
         self.logger = logging.getLogger('aioutp')
         self._loop = loop
         self._protocol = protocol
+        # share of the server's send bandwidth when it is congested; see
+        # UtpServer's fair_queue
+        self.weight = weight
         self._peername = (host, port)
         self._local_addr = local_addr
 
-        self.__writable = False
+        # accepted sockets are connected from the start
+        self.__connected = sock is not None
+        self.__writable = self.__connected
         self.__closing = False
         self.__closed = False
         self.__close_exception = None
         self.__paused_reading = False
-        self.__writing = False
-        self.__send_buf = deque()
+        # data received while a server-side transport is paused; it
+        # counts against libutp's receive window until handed over
+        self.__read_buf = deque()
+        self.__read_buf_size = 0
+
+        # Whatever libutp doesn't accept right away is kept here, as
+        # (buffer, offset) pairs, until the socket is writable again.
+        self.__write_buf = deque()
+        self.__write_buf_size = 0
+        self.__protocol_paused = False
+        self.set_write_buffer_limits()
+        self.__rate_limiter = None
+        self.__write_timer = None
+        if rate_limit is not None:
+            self.set_rate_limit(rate_limit, rate_burst)
+        self.__capture = capture
+        self.__clock = make_clock(loop, time_source)
+        self.telemetry = Telemetry(loop) if telemetry else None
 
         if sock is None:
             self.__server = None
             self._udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             self._udp_sock.setblocking(0)
-            self._udp_sock_fd = self._udp_sock.fileno()
 
             if local_addr == None:
                 self._udp_sock.bind(('127.0.0.1', 0))
             else:
-                self._udp_sock.bind(localaddr)
+                self._udp_sock.bind(local_addr)
 
             self.__ctx = utp.utp_init(2)
 
+            if path_mtu or tunnel_overhead:
+                mtu_cache = PathMtuCache(tunnel_overhead)
+                mtu_cache.set_callbacks(self.__ctx)
+            else:
+                mtu_cache = None
+            self.__endpoint = make_endpoint(io_mode, loop, self._udp_sock,
+                                            self.__ctx, self.__udp_error,
+                                            self.__clock, mtu_cache, offload,
+                                            rcvbuf, sndbuf, drop_stats)
+
             utp.utp_set_callback(self.__ctx, utp.UTP_SENDTO, self.__sendto_cb)
             utp.utp_set_callback(self.__ctx, utp.UTP_ON_STATE_CHANGE,
-                                 self.__state_change_cb)
-            utp.utp_set_callback(self.__ctx, utp.UTP_ON_ERROR, self.__error_cb)
-            utp.utp_set_callback(self.__ctx, utp.UTP_ON_READ, self.__read_cb)
-            utp.utp_set_callback(self.__ctx, utp.UTP_LOG, self.__log_cb)
-
-            if debug:
-                utp.utp_context_set_option(self.__ctx, utp.UTP_LOG_NORMAL, 1)
-                utp.utp_context_set_option(self.__ctx, utp.UTP_LOG_DEBUG, 1)
-                utp.utp_context_set_option(self.__ctx, utp.UTP_LOG_MTU, 1)
+                                 self._state_change_cb)
+            utp.utp_set_callback(self.__ctx, utp.UTP_ON_ERROR, self._error_cb)
+            utp.utp_set_callback(self.__ctx, utp.UTP_ON_READ, self._read_cb)
+            self.__log_handler = set_log_callback(
+                self.__ctx, self.logger, buffered_log, self.__log_cb)
+            set_clock_callbacks(self.__ctx, self.__clock)
+            if telemetry:
+                utp.utp_set_callback(self.__ctx, utp.UTP_ON_DELAY_SAMPLE,
+                                     self._delay_sample_cb)
+                utp.utp_set_callback(self.__ctx,
+                                     utp.UTP_ON_OVERHEAD_STATISTICS,
+                                     self._overhead_statistics_cb)
+
+            set_log_options(self.__ctx, debug, log_options)
+
+            if capture is not None:
+                capture.attach(self.__ctx)
 
             self.__sock = utp.utp_create_socket(self.__ctx)
             ret = utp.utp_connect(self.__sock, (host, port))
             if ret != 0:
                 raise RuntimeError('Could not establish UTP connection.')
+            add_clock_hook(self.__clock, self.check_timeouts)
 
-            self._loop.add_reader(self._udp_sock_fd, self.__read_udp)
+            self.__endpoint.start_reading()
         else:
             self.__sock = sock
             self.__ctx = ctx
             self.__server = server
+            self.__log_handler = None
+            self.__endpoint = None
 
         self.closed = asyncio.Event()
 
     def __sendto_cb(self, cb, ctx, sock, data, addr, flags):
-        self.__send_buf.append(data)
-        if not self.__writing:
-            self._loop.add_writer(self._udp_sock_fd, self.__write_udp)
-            self.__writing = True
+        if self.telemetry is not None:
+            self.telemetry.add(BYTES_SENT, len(data))
+        self.__endpoint.send(data, addr)
 
-    def __state_change_cb(self, cb, ctx, sock, state):
+    def _state_change_cb(self, cb, ctx, sock, state):
         if state in (utp.UTP_STATE_CONNECT, utp.UTP_STATE_WRITABLE):
+            if not self.__connected:
+                self.__connected = True
+                self._loop.call_soon(self._protocol.connection_made, self)
+                self._loop.call_later(0.5, self.__check_for_timeouts)
             self.__writable = True
-            self._loop.call_soon(self._protocol.connection_made, self)
-
-            self._loop.call_later(0.5, self.__check_for_timeouts)
+            if self.__write_buf:
+                self._loop.call_soon(self.__flush)
         elif state == utp.UTP_STATE_EOF:
             self._loop.call_soon(self._protocol.eof_received)
             self.close()
@@ -81,56 +979,79 @@ class UtpTransport(asyncio.Transport):
             if self.__server:
                 self.__server._transport_closed(self)
             else:
-                self._loop.remove_reader(self._udp_sock_fd)
-                utp.utp_destroy(self.__ctx)
+                # not from inside a libutp callback
+                self._loop.call_soon(self.__destroy_ctx)
         else:
             raise RuntimeError('Encountered unknown UTP state: {}', state)
 
-    def __error_cb(self, cb, ctx, sock, error_code):
+    def _error_cb(self, cb, ctx, sock, error_code):
         self.__close_exception = RuntimeError('UTP Error: {}'.format(error_code))
         self.close()
 
-    def __read_cb(self, cb, ctx, sock, data):
+    def _read_cb(self, cb, ctx, sock, data):
+        if self.__paused_reading and self.__endpoint is None:
+            self.__read_buf.append(data)
+            self.__read_buf_size += len(data)
+            return
         self._loop.call_soon(self._protocol.data_received, data)
         utp.utp_read_drained(self.__sock)
 
-    def __log_cb(self, cb, ctx, sock, msg):
-        self.logger.debug('UTP log: {}'.format(msg.decode()))
+    def _get_read_buffer_size_cb(self, cb, ctx, sock):
+        return self.__read_buf_size
 
-    def __read_udp(self):
-        drained = False
-        while not drained:
-            try:
-                data, addr = self._udp_sock.recvfrom(1500, socket.MSG_DONTWAIT)
-            except socket.error as e:
-                if e.errno == socket.EAGAIN or e.errno == socket.EWOULDBLOCK:
-                    utp.utp_issue_deferred_acks(self.__ctx)
-                    drained = True
-                else:
-                    self.__close_exception = e
-                    self.close()
-            else:
-                utp.utp_process_udp(self.__ctx, data, addr)
+    def __log_cb(self, cb, ctx, sock, args):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            msg = ctypes.string_at(args.buf).decode('utf-8', errors='replace')
+            self.logger.debug('UTP log: %s', msg)
 
-    def __write_udp(self):
-        while len(self.__send_buf) != 0:
-            data = self.__send_buf.pop()
-            sent = self._udp_sock.sendto(data, self._peername)
-            if sent < len(data):
-                raise RuntimeError('Could not send datagram.')
+    def _delay_sample_cb(self, cb, ctx, sock, sample_ms):
+        self.telemetry.add(DELAY_SAMPLE, sample_ms)
 
-        self._loop.remove_writer(self._udp_sock_fd)
-        self.__writing = False
+    def _overhead_statistics_cb(self, cb, ctx, sock, send, length, type):
+        if type == utp.RETRANSMIT_OVERHEAD:
+            self.telemetry.add(RETRANSMIT, length)
+
+    def __udp_error(self, exc):
+        self.__close_exception = exc
+        self.close()
 
     def __check_for_timeouts(self):
-        if self.__closing or self.__closed:
+        # keep going while closing: libutp only retransmits, and only
+        # gets to UTP_STATE_DESTROYING, from utp_check_timeouts
+        if self.__closed:
             return
 
-        utp.utp_check_timeouts(self.__ctx)
+        self.check_timeouts()
         self._loop.call_later(0.5, self.__check_for_timeouts)
 
+    def check_timeouts(self):
+        """Let libutp handle any timeouts and retransmissions that are
+        due now. This happens periodically anyway; call it to check
+        right away, e.g. after advancing a VirtualClock."""
+        if self.__server is not None:
+            self.__server.check_timeouts()
+            return
+        if self.__ctx is None:
+            return
+        if self.__clock is not None:
+            self.__clock.refresh()
+        utp.utp_check_timeouts(self.__ctx)
+
     def close(self):
+        if self.__closed or (self.__closing and not self.__write_buf):
+            return
         self.__closing = True
+        if self.__write_buf and self.__close_exception is None:
+            # utp_close is called once the buffer has been flushed
+            return
+        self.__close()
+
+    def __close(self):
+        self.__write_buf.clear()
+        self.__write_buf_size = 0
+        if self.__write_timer is not None:
+            self.__write_timer.cancel()
+            self.__write_timer = None
         utp.utp_close(self.__sock)
         self._loop.call_soon(self._protocol.connection_lost,
                              self.__close_exception)
@@ -139,6 +1060,10 @@ class UtpTransport(asyncio.Transport):
         return self.__closing
 
     def get_extra_info(self, name, default=None):
+        if name == 'kernel_drops':
+            if self.__server is not None:
+                return self.__server.kernel_drops
+            return self.__endpoint.kernel_drops
         return {
             'peername': self._peername,
             'socket': self.__sock,
@@ -151,185 +1076,788 @@ class UtpTransport(asyncio.Transport):
         if self.__paused_reading:
             raise RuntimeError('Already paused.')
         self.__paused_reading = True
-        self._loop.remove_reader(self._udp_sock_fd)
+        if self.__endpoint is not None:
+            self.__endpoint.stop_reading()
 
     def resume_reading(self):
         if not self.__paused_reading:
             raise RuntimeError('Not paused.')
         self.__paused_reading = False
-        self._loop.add_reader(self._udp_sock_fd, self.__read_udp)
+        if self.__endpoint is not None:
+            self.__endpoint.start_reading()
+            return
+        # Server-side transports share the server's UDP sockets, so
+        # they can't stop reading them; hand over what was held back
+        # and let libutp open the receive window again.
+        if not self.__read_buf:
+            return
+        while self.__read_buf:
+            self._loop.call_soon(self._protocol.data_received,
+                                 self.__read_buf.popleft())
+        self.__read_buf_size = 0
+        if not self.__closed:
+            utp.utp_read_drained(self.__sock)
 
     def write(self, data):
-        utp.utp_write(self.__sock, data)
+        if not data or self.__closing or self.__closed:
+            return
+        if self.__clock is not None:
+            self.__clock.refresh()
+
+        if type(data) is not bytes:
+            data = memoryview(data).cast('B')
+            if data.readonly:
+                # libutp needs an address to read from
+                data = bytes(data)
+        offset = 0
+        if self.__writable and not self.__write_buf:
+            offset = self.__write(data, 0)
+            if offset >= len(data):
+                return
+
+        if type(data) is not bytes:
+            # the caller may reuse the buffer once write returns
+            data = bytes(data[offset:])
+            offset = 0
+        self.__write_buf.append((data, offset))
+        self.__write_buf_size += len(data) - offset
+        self.__maybe_pause_protocol()
+
+    def writelines(self, list_of_data):
+        # unlike asyncio's default, don't join the buffers first
+        for data in list_of_data:
+            self.write(data)
+
+    def __write(self, data, offset):
+        # Hand data from offset on to libutp, as far as it and the rate
+        # limit allow, and return the number of bytes it took.
+        count = len(data) - offset
+        rate_limiter = self.__rate_limiter
+        if rate_limiter is None:
+            granted = count
+        else:
+            granted = rate_limiter.take(count)
+            if granted == 0:
+                self.__schedule_flush(count)
+                return 0
+
+        n = utp.utp_write(self.__sock, data, offset, granted)
+        if n < granted:
+            # libutp's send buffer is full; wait for WRITABLE
+            self.__writable = False
+            if rate_limiter is not None:
+                rate_limiter.refund(granted - n)
+        elif granted < count:
+            self.__schedule_flush(count - granted)
+        return n
+
+    def __schedule_flush(self, count):
+        if self.__write_timer is None:
+            # wait for at least a datagram's worth of tokens
+            delay = self.__rate_limiter.delay(min(count, 1500))
+            self.__write_timer = self._loop.call_later(
+                delay, self.__timed_flush)
+
+    def __timed_flush(self):
+        self.__write_timer = None
+        if self.__writable:
+            self.__flush()
+
+    def set_rate_limit(self, rate, burst=None):
+        """Limit the rate at which written data is handed to libutp, in
+        bytes per second; None removes the limit."""
+        if rate is None:
+            self.__rate_limiter = None
+        else:
+            self.__rate_limiter = TokenBucket(self._loop, rate, burst)
+        if self.__write_timer is not None:
+            self.__write_timer.cancel()
+            self.__write_timer = None
+        if self.__writable and self.__write_buf:
+            self._loop.call_soon(self.__flush)
+
+    def __flush(self):
+        if self.__closed or not self.__write_buf:
+            return
+        if self.__clock is not None:
+            self.__clock.refresh()
+
+        buf = self.__write_buf
+        while buf:
+            data, offset = buf[0]
+            n = self.__write(data, offset)
+            self.__write_buf_size -= n
+            if offset + n < len(data):
+                buf[0] = (data, offset + n)
+                break
+            buf.popleft()
+
+        if not buf and self.__closing:
+            self.__close()
+        else:
+            self.__maybe_resume_protocol()
+
+    def __maybe_pause_protocol(self):
+        if self.__write_buf_size > self.__high_water \
+           and not self.__protocol_paused:
+            self.__protocol_paused = True
+            self._protocol.pause_writing()
+
+    def __maybe_resume_protocol(self):
+        if self.__write_buf_size <= self.__low_water \
+           and self.__protocol_paused:
+            self.__protocol_paused = False
+            self._protocol.resume_writing()
+
+    def get_write_buffer_size(self):
+        return self.__write_buf_size
+
+    def get_write_buffer_limits(self):
+        return (self.__low_water, self.__high_water)
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        if high is None:
+            high = 64 * 1024 if low is None else 4 * low
+        if low is None:
+            low = high // 4
+        if not high >= low >= 0:
+            raise ValueError('high ({}) must be >= low ({}) must be >= 0'
+                             .format(high, low))
+        self.__high_water = high
+        self.__low_water = low
+
+    @property
+    def weight(self):
+        return self.__weight
+
+    @weight.setter
+    def weight(self, weight):
+        if not weight > 0:
+            raise ValueError('weight must be > 0, not {}'.format(weight))
+        self.__weight = weight
 
     def can_write_eof(self):
         return False
 
+    def __destroy_ctx(self):
+        # only for client transports, which own their context
+        if self.__ctx is None:
+            return
+        self.__endpoint.close()
+        remove_clock_hook(self.__clock, self.check_timeouts)
+        ctx = self.__ctx
+        self.__ctx = None
+        try:
+            if self.__capture is not None:
+                self.__capture.detach(ctx)
+        finally:
+            utp.utp_destroy(ctx)
+        if self.__log_handler is not None:
+            self.__log_handler.close()
+
     def abort(self):
+        self.__write_buf.clear()
+        self.__write_buf_size = 0
+        if self.__write_timer is not None:
+            self.__write_timer.cancel()
+            self.__write_timer = None
         utp.utp_close(self.__sock)
-        utp.utp_destroy(self.__ctx)
         self._loop.call_soon(self._protocol.connection_lost, None)
-        self.closed = False
+        if self.__server is None:
+            self.__closed = True
+            self.closed.set()
+            self.__destroy_ctx()
+        # server-side transports are cleaned up on UTP_STATE_DESTROYING
 
     async def wait_closed(self):
         await self.closed.wait()
 
+# maximum number of peer routes a multi-address server keeps before
+# pruning the ones without a transport
+MAX_ROUTES = 65536
+
+# messages exchanged during a hot restart; see UtpServer.hand_off
+HANDOFF_MAGIC = b'UTPHANDOFF'
+HANDOFF_RELEASED = b'R'
+MAX_HANDOFF_FDS = 64
+
+# number of peers, then each peer's IPv4 address and port
+HANDOFF_COUNT = struct.Struct('!I')
+HANDOFF_PEER = struct.Struct('!4sH')
+
+# endpoint index, peer IPv4 address and port; followed by the datagram
+FORWARD_HEADER = struct.Struct('!B4sH')
+# endpoint index of a message that only says the peer's connection in
+# the old process is gone
+FORWARD_RELEASE = 255
+
+class HandoffForwarder:
+    """During a hot restart, both processes read the shared UDP sockets,
+    and each datagram reaches whichever one reads it first. The old
+    process keeps the connections it had when it handed the sockets
+    off (peers); everything else belongs to the new one. Each side
+    passes the datagrams it reads that belong to the other over a Unix
+    datagram socket, and feeds the ones it gets from there to its own
+    context. local says whether peers are handled on this side."""
+
+    def __init__(self, loop, sock, peers, local):
+        self._loop = loop
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.peers = set(peers)
+        self.local = local
+        self.__indexes = {}
+        self.__endpoints = []
+        self.__deliver = None
+        self.__closed = False
+
+    def start(self, endpoints, deliver):
+        """Start forwarding for endpoints, in the same order on both
+        sides. deliver is called with a list of (endpoint, data, addr)
+        for each batch of datagrams forwarded from the other side."""
+        self.__endpoints = endpoints
+        self.__deliver = deliver
+        for i, endpoint in enumerate(endpoints):
+            self.__indexes[endpoint] = i
+            endpoint.forwarder = self
+        self._loop.add_reader(self.sock.fileno(), self.__read)
+
+    def forwards(self, addr):
+        return (addr in self.peers) is not self.local
+
+    def forward(self, endpoint, data, addr):
+        self.__send(self.__indexes[endpoint], data, addr)
+
+    def release(self, addr):
+        """Hand a peer whose connection has ended over to the other
+        side."""
+        self.peers.discard(addr)
+        self.__send(FORWARD_RELEASE, b'', addr)
+
+    def __send(self, index, data, addr):
+        header = FORWARD_HEADER.pack(index, socket.inet_aton(addr[0]),
+                                     addr[1])
+        try:
+            self.sock.sendmsg([header, data])
+        except OSError:
+            # as good as lost on the way; libutp will retransmit
+            pass
+
+    def __read(self):
+        datagrams = []
+        while True:
+            try:
+                data = self.sock.recv(FORWARD_HEADER.size + RECV_BUF_SIZE)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                self.close()
+                break
+            if len(data) < FORWARD_HEADER.size:
+                continue
+            index, host, port = FORWARD_HEADER.unpack_from(data)
+            addr = (socket.inet_ntoa(host), port)
+            if index == FORWARD_RELEASE:
+                self.peers.discard(addr)
+            elif index < len(self.__endpoints):
+                datagrams.append((self.__endpoints[index],
+                                  data[FORWARD_HEADER.size:], addr))
+        if datagrams:
+            self.__deliver(datagrams)
+
+    def close(self):
+        if self.__closed:
+            return
+        self.__closed = True
+        for endpoint in self.__endpoints:
+            if endpoint.forwarder is self:
+                endpoint.forwarder = None
+        if self.__deliver is not None:
+            self._loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+
+class Handoff:
+    """The sockets of a server handing off to this process, as returned
+    by take_over; pass it to create_server as handoff. Until the old
+    server is done with its connections, their datagrams are passed
+    back to it; released is set when it is."""
+
+    def __init__(self, loop, conn, sockets, forward_sock, peers):
+        self.sockets = sockets
+        self.forwarder = HandoffForwarder(loop, forward_sock, peers, False)
+        self.released = asyncio.Event()
+        self._loop = loop
+        self.__conn = conn
+        loop.add_reader(conn.fileno(), self.__conn_readable)
+
+    def __conn_readable(self):
+        # HANDOFF_RELEASED, or end of file if the old process went
+        # away; either way its connections are gone
+        try:
+            self.__conn.recv(len(HANDOFF_RELEASED))
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            pass
+        self._loop.remove_reader(self.__conn.fileno())
+        self.__conn.close()
+        self.forwarder.close()
+        self.released.set()
+
 class UtpServer:
-    def __init__(self, proto_factory, loop, bind_host, bind_port, debug=False):
+    def __init__(self, proto_factory, loop, bind_host, bind_port, debug=False,
+                 capture=None, time_source=None, telemetry=False,
+                 log_options=None, buffered_log=False, path_mtu=False,
+                 tunnel_overhead=0, offload=False, rcvbuf=None,
+                 sndbuf=None, drop_stats=False, addresses=None,
+                 io_mode='reader', sock=None, fair_queue=False,
+                 rate_limit=None, rate_burst=None, handoff=None):
+        # set first, so that __del__ works even if __init__ fails
+        self.__ctx = None
+        self.__capture = None
+        self.__log_handler = None
+        self.__forwarder = None
+        check_io_mode(io_mode, offload, drop_stats, fair_queue)
         self.logger = logging.getLogger('aioutp')
         self.__debug = debug
-        self.transports = []
+        self.__clock = make_clock(loop, time_source)
+        self.__telemetry = telemetry
+        self.__fair_queue = fair_queue
+        # paces the datagrams of all the server's endpoints together
+        if rate_limit is None:
+            self.__rate_limiter = None
+        else:
+            self.__rate_limiter = TokenBucket(loop, rate_limit, rate_burst)
+        self.__closing = False
+        self.__transport_map = {}
         self._proto_factory = proto_factory
         self._loop = loop
         self._bind_host = bind_host
         self._bind_port = bind_port
-        self._udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self._udp_sock.setblocking(0)
-        self._udp_sock_fd = self._udp_sock.fileno()
 
         if bind_host is None:
             bind_host = '127.0.0.1'
         if bind_port is None:
             bind_port = 0
 
-        self._udp_sock.bind((bind_host, bind_port))
+        # The server can listen on several addresses, all sharing the
+        # same context. addresses is a list of (host, port) pairs;
+        # bind_host can also be a list of hosts to bind on bind_port.
+        # Alternatively, sock is an already bound UDP socket, or a list
+        # of them, or handoff is what take_over returned.
+        if handoff is not None:
+            sock = handoff.sockets
+        if sock is not None:
+            socks = list(sock) if isinstance(sock, (list, tuple)) else [sock]
+            addresses = [s.getsockname() for s in socks]
+        else:
+            socks = None
+            if addresses is None:
+                if isinstance(bind_host, (list, tuple)):
+                    addresses = [(host, bind_port) for host in bind_host]
+                else:
+                    addresses = [(bind_host, bind_port)]
 
         self.__ctx = utp.utp_init(2)
 
+        if path_mtu or tunnel_overhead:
+            mtu_cache = PathMtuCache(tunnel_overhead)
+            mtu_cache.set_callbacks(self.__ctx)
+        else:
+            mtu_cache = None
+
+        # peer address -> the endpoint it last sent to us on; only
+        # needed when there is more than one endpoint
+        self.__routes = {} if len(addresses) > 1 else None
+        self.__endpoints = []
+        for i, address in enumerate(addresses):
+            if socks is None:
+                udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                udp_sock.bind(address)
+            else:
+                udp_sock = socks[i]
+            udp_sock.setblocking(0)
+            self.__endpoints.append(
+                make_endpoint(io_mode, loop, udp_sock, self.__ctx,
+                              self.__udp_error, self.__clock, mtu_cache,
+                              offload, rcvbuf, sndbuf, drop_stats,
+                              self.__routes, fair_queue,
+                              self.__rate_limiter))
+        self.__endpoint = self.__endpoints[0]
+        self._udp_sock = self.__endpoint.sock
+
         utp.utp_set_callback(self.__ctx, utp.UTP_SENDTO, self.__sendto_cb)
         utp.utp_set_callback(self.__ctx, utp.UTP_ON_STATE_CHANGE,
                              self.__state_change_cb)
         utp.utp_set_callback(self.__ctx, utp.UTP_ON_ERROR, self.__error_cb)
         utp.utp_set_callback(self.__ctx, utp.UTP_ON_READ, self.__read_cb)
+        utp.utp_set_callback(self.__ctx, utp.UTP_GET_READ_BUFFER_SIZE,
+                             self.__get_read_buffer_size_cb)
         utp.utp_set_callback(self.__ctx, utp.UTP_ON_ACCEPT, self.__accept_cb)
-        utp.utp_set_callback(self.__ctx, utp.UTP_LOG, self.__log_cb)
-
-        if debug:
-            utp.utp_context_set_option(self.__ctx, utp.UTP_LOG_NORMAL, 1)
-            utp.utp_context_set_option(self.__ctx, utp.UTP_LOG_DEBUG, 1)
-            utp.utp_context_set_option(self.__ctx, utp.UTP_LOG_MTU, 1)
+        utp.utp_set_callback(self.__ctx, utp.UTP_ON_FIREWALL,
+                             self.__firewall_cb)
+        self.__log_handler = set_log_callback(
+            self.__ctx, self.logger, buffered_log, self.__log_cb)
+        set_clock_callbacks(self.__ctx, self.__clock)
+        if telemetry:
+            utp.utp_set_callback(self.__ctx, utp.UTP_ON_DELAY_SAMPLE,
+                                 self.__delay_sample_cb)
+            utp.utp_set_callback(self.__ctx, utp.UTP_ON_OVERHEAD_STATISTICS,
+                                 self.__overhead_statistics_cb)
+
+        set_log_options(self.__ctx, debug, log_options)
+
+        self.__capture = capture
+        if capture is not None:
+            capture.attach(self.__ctx)
 
-        self.__writing = False
-        self.__send_buf = deque()
         self.closed = asyncio.Event()
-
-        self._loop.add_reader(self._udp_sock_fd, self.__read_udp)
+        self.__accepting = True
+        self.__drain_timer = None
+
+        for endpoint in self.__endpoints:
+            endpoint.start_reading()
+        if handoff is not None:
+            self.__forwarder = handoff.forwarder
+            self.__forwarder.start(self.__endpoints, self.__deliver)
+        add_clock_hook(self.__clock, self.check_timeouts)
         self._loop.call_later(0.5, self.__check_for_timeouts)
 
     def __sendto_cb(self, cb, ctx, sock, data, addr, flags):
-        self.__send_buf.append((data, addr))
-        if not self.__writing:
-            self._loop.add_writer(self._udp_sock_fd, self.__write_udp)
-            self.__writing = True
+        if self.__routes is None:
+            endpoint = self.__endpoint
+        else:
+            endpoint = self.__routes.get(addr, self.__endpoint)
+        if not (self.__telemetry or self.__fair_queue):
+            endpoint.send(data, addr)
+            return
+
+        transport = self.__transport_map.get(sock)
+        if transport is None:
+            # e.g. a reset for a connection we don't know
+            endpoint.send(data, addr)
+            return
+        if self.__telemetry:
+            transport.telemetry.add(BYTES_SENT, len(data))
+        endpoint.send(data, addr, sock, transport.weight)
 
     def __state_change_cb(self, cb, ctx, sock, state):
-        if self.transports or self.__closing_transports:
-            transport = self.__get_transport(sock)
-            transport._UtpTransport__state_change_cb(cb, ctx, sock, state)
+        transport = self.__transport_map.get(sock)
+        if transport is not None:
+            transport._state_change_cb(cb, ctx, sock, state)
 
     def __error_cb(self, cb, ctx, sock, error_code):
         transport = self.__get_transport(sock)
-        proto = transport._protocol
-        transport.__close_exception = RuntimeError(
-            'UTP Error: {}'.format(error_code))
-        transport.close()
+        transport._error_cb(cb, ctx, sock, error_code)
 
     def __read_cb(self, cb, ctx, sock, data):
         transport = self.__get_transport(sock)
-        proto = transport._protocol
-        self._loop.call_soon(proto.data_received, data)
-        utp.utp_read_drained(sock)
+        transport._read_cb(cb, ctx, sock, data)
+
+    def __get_read_buffer_size_cb(self, cb, ctx, sock):
+        transport = self.__transport_map.get(sock)
+        if transport is None:
+            return 0
+        return transport._get_read_buffer_size_cb(cb, ctx, sock)
+
+    def __firewall_cb(self, cb, ctx, addr):
+        # non-zero rejects the connection
+        return 0 if self.__accepting else 1
 
     def __accept_cb(self, cb, ctx, sock, addr):
-        if self.sockets is None:
+        if self.__closing:
             raise RuntimeError('Connection arrived on closed server.')
 
+        if self.__routes is None:
+            endpoint = self.__endpoint
+        else:
+            endpoint = self.__routes.get(addr, self.__endpoint)
+
         proto = self._proto_factory()
         transport = UtpTransport(self._loop, proto, addr[0], addr[1],
-                                 (self._bind_host, self._bind_port),
-                                 sock, self.__ctx, self, debug=self.__debug)
+                                 endpoint.local_addr,
+                                 sock, self.__ctx, self, debug=self.__debug,
+                                 time_source=self.__clock,
+                                 telemetry=self.__telemetry)
         self._loop.call_soon(proto.connection_made, transport)
-        self.transports.append(transport)
+        self.__transport_map[sock] = transport
 
-    def __log_cb(self, cb, ctx, sock, msg):
-        self.logger.debug('UTP log: {}'.format(msg.decode()))
+    def __log_cb(self, cb, ctx, sock, args):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            msg = ctypes.string_at(args.buf).decode('utf-8', errors='replace')
+            self.logger.debug('UTP log: %s', msg)
 
-    def __read_udp(self):
-        drained = False
-        while not drained:
-            try:
-                data, addr = self._udp_sock.recvfrom(1500, socket.MSG_DONTWAIT)
-            except socket.error as e:
-                if e.errno == socket.EAGAIN or e.errno == socket.EWOULDBLOCK:
-                    utp.utp_issue_deferred_acks(self.__ctx)
-                    drained = True
-                else:
-                    raise e
-            else:
-                utp.utp_process_udp(self.__ctx, data, addr)
+    def __delay_sample_cb(self, cb, ctx, sock, sample_ms):
+        transport = self.__transport_map.get(sock)
+        if transport is not None:
+            transport._delay_sample_cb(cb, ctx, sock, sample_ms)
 
-    def __write_udp(self):
-        while len(self.__send_buf) != 0:
-            data, peer = self.__send_buf.pop()
-            sent = self._udp_sock.sendto(data, peer)
-            if sent < len(data):
-                raise RuntimeError('Could not send datagram.')
+    def __overhead_statistics_cb(self, cb, ctx, sock, send, length, type):
+        transport = self.__transport_map.get(sock)
+        if transport is not None:
+            transport._overhead_statistics_cb(cb, ctx, sock, send, length,
+                                              type)
 
-        self._loop.remove_writer(self._udp_sock_fd)
-        self.__writing = False
+    def __udp_error(self, exc):
+        self.logger.error('Error reading from UDP socket: {}'.format(exc))
 
     def __check_for_timeouts(self):
         if self.closed.is_set():
             return
 
-        utp.utp_check_timeouts(self.__ctx)
+        self.check_timeouts()
         self._loop.call_later(0.5, self.__check_for_timeouts)
 
+    def check_timeouts(self):
+        """Let libutp handle any timeouts and retransmissions that are
+        due now, for all of the server's connections."""
+        if self.__ctx is None:
+            return
+        if self.__clock is not None:
+            self.__clock.refresh()
+        utp.utp_check_timeouts(self.__ctx)
+
+    def __prune_routes(self, peer):
+        self.__routes.pop(peer, None)
+        if len(self.__routes) > MAX_ROUTES:
+            # Mostly peers that never connected; keep only the ones we
+            # have transports for.
+            peers = set(t.get_extra_info('peername')
+                        for t in self.__transport_map.values())
+            for addr in list(self.__routes):
+                if addr not in peers:
+                    del self.__routes[addr]
+
     def __get_transport(self, sock):
-        transports = self.transports if self.transports is not None \
-                     else self.__closing_transports
-        t = [t for t in transports if t.get_extra_info('socket') == sock]
-        if not t:
+        try:
+            return self.__transport_map[sock]
+        except KeyError:
             raise RuntimeError('Encountered unknown socket.')
-        if len(t) > 1:
-            raise RuntimeError('More than one transport for one socket.')
-
-        return t[0]
 
     def _transport_closed(self, transport):
-        if self.transports:
-            del self.transports[self.transports.index(transport)]
-        else:
-            del self.__closing_transports[self.__closing_transports.index(transport)]
-            if len(self.__closing_transports) == 0:
-                self.closed.set()
+        del self.__transport_map[transport.get_extra_info('socket')]
+        if self.__routes is not None:
+            self.__prune_routes(transport.get_extra_info('peername'))
+        if self.__forwarder is not None and self.__forwarder.local:
+            self.__forwarder.release(transport.get_extra_info('peername'))
+        if self.__closing and not self.__transport_map:
+            self.__set_closed()
+
+    def __set_closed(self):
+        if self.__drain_timer is not None:
+            self.__drain_timer.cancel()
+            self.__drain_timer = None
+        self.closed.set()
+        # this can be called from a libutp callback, where the context
+        # can't be destroyed
+        self._loop.call_soon(self.__destroy)
+
+    def __destroy(self):
+        if self.__ctx is None:
+            return
+        if self.__forwarder is not None:
+            self.__forwarder.close()
+        for endpoint in self.__endpoints:
+            endpoint.close()
+        self.__destroy_ctx()
 
     def __del__(self):
-        utp.utp_destroy(self.__ctx)
+        if self.__ctx is not None:
+            self.__destroy_ctx()
+
+    def __destroy_ctx(self):
+        remove_clock_hook(self.__clock, self.check_timeouts)
+        ctx = self.__ctx
+        self.__ctx = None
+        try:
+            if self.__capture is not None:
+                self.__capture.detach(ctx)
+        finally:
+            utp.utp_destroy(ctx)
+        if self.__log_handler is not None:
+            self.__log_handler.close()
 
     @property
-    def sockets(self):
-        if self.transports is None:
+    def kernel_drops(self):
+        """The number of datagrams the kernel has dropped because the
+        receive buffers of the UDP sockets were full, or None if
+        drop_stats was not enabled (or is not supported)."""
+        drops = [e.kernel_drops for e in self.__endpoints
+                 if e.kernel_drops is not None]
+        return sum(drops) if drops else None
+
+    def set_rate_limit(self, rate, burst=None):
+        """Change the server-wide limit on the rate at which datagrams
+        are sent, in bytes per second. It can't be added to or removed
+        from a server created without rate_limit."""
+        if self.__rate_limiter is None:
+            raise RuntimeError('Server was created without a rate limit.')
+        self.__rate_limiter.set_rate(rate, burst)
+
+    @property
+    def addresses(self):
+        """The local addresses the server is listening on."""
+        return [e.sock.getsockname() for e in self.__endpoints]
+
+    @property
+    def transports(self):
+        """The open transports, or None once the server is closing."""
+        if self.__closing:
             return None
-        else:
-            return [t.get_extra_info('socket') for t in self.transports]
+        return list(self.__transport_map.values())
 
-    def close(self):
-        if self.transports is None:
+    @property
+    def sockets(self):
+        if self.__closing:
+            return None
+        return list(self.__transport_map)
+
+    def close(self, drain=False, timeout=None):
+        """Stop accepting connections and close the server. With
+        drain=True, the existing connections are left to finish on
+        their own, or closed after timeout seconds if one is given;
+        otherwise they are closed right away. Once they are all gone,
+        the UDP sockets are closed and the context destroyed."""
+        if self.__closing:
+            if not drain and not self.closed.is_set():
+                # close what's still draining now
+                self.__close_transports()
             return
 
-        for t in self.transports:
-            t.close()
-
-        self.__closing_transports = self.transports
-        self.transports = None
+        self.__accepting = False
+        self.__closing = True
 
-        if not self.__closing_transports:
-            self.closed.set()
+        if not self.__transport_map:
+            self.__set_closed()
+        elif not drain:
+            self.__close_transports()
+        elif timeout is not None:
+            self.__drain_timer = self._loop.call_later(
+                timeout, self.__close_transports)
+
+    def __close_transports(self):
+        if self.__drain_timer is not None:
+            self.__drain_timer.cancel()
+            self.__drain_timer = None
+        for t in list(self.__transport_map.values()):
+            t.close()
 
     async def wait_closed(self):
         await self.closed.wait()
 
+    async def hand_off(self, path, drain_timeout=None):
+        """Hand the server's UDP sockets over to another process, which
+        gets them by calling take_over with the same Unix socket path.
+        From then on, the successor accepts new connections, while this
+        server keeps serving the ones it has until they finish (or
+        drain_timeout expires) and then closes. Datagrams that either
+        process reads for the other's connections are passed on to it
+        (see HandoffForwarder).
+
+        Connections are told apart by peer address, so a client that
+        reconnects from the same address and port before its old
+        connection is gone reaches the old server, which rejects it."""
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.setblocking(False)
+        try:
+            listener.bind(path)
+        except OSError:
+            listener.close()
+            raise
+        try:
+            listener.listen(1)
+            conn, _ = await self._loop.sock_accept(listener)
+        finally:
+            listener.close()
+            os.unlink(path)
+
+        with conn:
+            conn.setblocking(False)
+            local, remote = socket.socketpair(socket.AF_UNIX,
+                                              socket.SOCK_DGRAM)
+            # from here on, until the successor has started, datagrams
+            # for new connections wait in the socket pair
+            peers = [t.get_extra_info('peername')
+                     for t in self.__transport_map.values()]
+            self.__forwarder = HandoffForwarder(self._loop, local, peers,
+                                                True)
+            self.__forwarder.start(self.__endpoints, self.__deliver)
+            self.close(drain=True, timeout=drain_timeout)
+            try:
+                fds = [e.sock.fileno() for e in self.__endpoints]
+                socket.send_fds(conn, [HANDOFF_MAGIC +
+                                       HANDOFF_COUNT.pack(len(peers))],
+                                fds + [remote.fileno()])
+            finally:
+                remote.close()
+            await self._loop.sock_sendall(conn, b''.join(
+                HANDOFF_PEER.pack(socket.inet_aton(host), port)
+                for host, port in peers))
+
+            await self.wait_closed()
+            self.__forwarder.close()
+            await self._loop.sock_sendall(conn, HANDOFF_RELEASED)
+
+    def __deliver(self, datagrams):
+        # datagrams the other process read for our connections
+        if self.__ctx is None:
+            return
+        if self.__clock is not None:
+            self.__clock.refresh()
+        for endpoint, data, addr in datagrams:
+            if self.__routes is not None:
+                self.__routes[addr] = endpoint
+            utp.utp_process_udp(self.__ctx, data, addr)
+        utp.utp_issue_deferred_acks(self.__ctx)
+
+async def take_over(path, loop=None):
+    """Take over the UDP sockets of a server that is handing them off
+    from path (see UtpServer.hand_off). Returns a Handoff as soon as the
+    sockets have arrived; pass it to create_server as handoff, which
+    starts accepting new connections right away."""
+    if loop is None:
+        loop = asyncio.get_event_loop()
+
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    socks = []
+    try:
+        conn.setblocking(False)
+        await loop.sock_connect(conn, path)
+
+        readable = loop.create_future()
+        loop.add_reader(conn.fileno(),
+                        lambda: readable.done() or readable.set_result(None))
+        try:
+            await readable
+        finally:
+            loop.remove_reader(conn.fileno())
+        size = len(HANDOFF_MAGIC) + HANDOFF_COUNT.size
+        msg, fds, flags, addr = socket.recv_fds(conn, size, MAX_HANDOFF_FDS)
+        socks = [socket.socket(fileno=fd) for fd in fds]
+        # the UDP sockets, then our end of the forwarding socket pair
+        if len(msg) != size or not msg.startswith(HANDOFF_MAGIC) or \
+           len(socks) < 2:
+            raise RuntimeError('Invalid handoff from {}.'.format(path))
+        count, = HANDOFF_COUNT.unpack_from(msg, len(HANDOFF_MAGIC))
+
+        data = b''
+        while len(data) < count * HANDOFF_PEER.size:
+            chunk = await loop.sock_recv(
+                conn, count * HANDOFF_PEER.size - len(data))
+            if not chunk:
+                raise RuntimeError('Handoff from {} aborted.'.format(path))
+            data += chunk
+    except:
+        for s in socks:
+            s.close()
+        conn.close()
+        raise
+
+    peers = [(socket.inet_ntoa(host), port)
+             for host, port in HANDOFF_PEER.iter_unpack(data)]
+    forward_sock = socks.pop()
+    return Handoff(loop, conn, socks, forward_sock, peers)
+
 class StreamReaderProtocol(asyncio.Protocol):
     def __init__(self, stream_reader, client_connected_cb=None, loop=None):
         self._loop = loop
@@ -337,6 +1865,9 @@ class StreamReaderProtocol(asyncio.Protocol):
         self._stream_writer = None
         self._client_connected_cb = client_connected_cb
         self._connection_made = asyncio.Event()
+        self._connection_lost = False
+        self._paused = False
+        self._drain_waiters = deque()
 
     def connection_made(self, transport):
         self._stream_reader.set_transport(transport)
@@ -356,6 +1887,38 @@ class StreamReaderProtocol(asyncio.Protocol):
         else:
             self._stream_reader.set_exception(exc)
 
+        self._connection_lost = True
+        self._paused = False
+        for waiter in self._drain_waiters:
+            if not waiter.done():
+                if exc is None:
+                    waiter.set_result(None)
+                else:
+                    waiter.set_exception(exc)
+
+    def pause_writing(self):
+        self._paused = True
+
+    def resume_writing(self):
+        self._paused = False
+        for waiter in self._drain_waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def _drain_helper(self):
+        # called by StreamWriter.drain
+        if self._connection_lost:
+            raise ConnectionResetError('Connection lost')
+        if not self._paused:
+            return
+        loop = self._loop or asyncio.get_event_loop()
+        waiter = loop.create_future()
+        self._drain_waiters.append(waiter)
+        try:
+            await waiter
+        finally:
+            self._drain_waiters.remove(waiter)
+
     def data_received(self, data):
         self._stream_reader.feed_data(data)
 
@@ -363,17 +1926,146 @@ class StreamReaderProtocol(asyncio.Protocol):
         self._stream_reader.feed_eof()
         return True
 
+# length prefix of the frames used by FramedProtocol
+FRAME_HEADER = struct.Struct('!I')
+
+class FramedProtocol(asyncio.Protocol):
+    """A protocol for messages framed by a 4-byte big-endian length
+    prefix. Frames are parsed straight out of the received data, or out
+    of an internal buffer when they span several reads, and passed to
+    frame_received.
+
+    If a frame_received callback is given, it is called with each frame
+    as a memoryview that is only valid until it returns; copy it with
+    bytes() to keep it. Otherwise frames are copied into a queue and can
+    be read with "async for frame in protocol". Subclasses can also
+    override frame_received."""
+
+    def __init__(self, frame_received=None, max_frame_size=16 * 1024 * 1024,
+                 max_queued=1024, loop=None):
+        self.transport = None
+        self.max_frame_size = max_frame_size
+        self.max_queued = max_queued
+        self._loop = loop
+        self.__callback = frame_received
+        self.__buf = bytearray()
+        self.__frames = deque()
+        self.__waiter = None
+        self.__paused = False
+        self.__eof = False
+        self.__exception = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.__eof = True
+        if self.__exception is None:
+            self.__exception = exc
+        self.__wakeup()
+
+    def data_received(self, data):
+        if self.__eof:
+            return
+        buf = self.__buf
+        if buf:
+            buf += data
+            data = buf
+
+        with memoryview(data) as view:
+            offset = self.__parse(view)
+
+        if data is buf:
+            try:
+                del buf[:offset]
+            except BufferError:
+                # a callback kept one of the frames; leave it the old
+                # buffer
+                self.__buf = bytearray(buf[offset:])
+        elif offset < len(data):
+            # only the incomplete frame at the end is copied
+            buf += memoryview(data)[offset:]
+
+    def __parse(self, view):
+        offset = 0
+        end = len(view)
+        while end - offset >= FRAME_HEADER.size and not self.__eof:
+            length, = FRAME_HEADER.unpack_from(view, offset)
+            if length > self.max_frame_size:
+                self.__exception = RuntimeError(
+                    'Frame too large: {} bytes.'.format(length))
+                self.__eof = True
+                self.__wakeup()
+                self.transport.close()
+                return end
+            start = offset + FRAME_HEADER.size
+            if end - start < length:
+                break
+            offset = start + length
+            with view[start:offset] as frame:
+                self.frame_received(frame)
+        return offset
+
+    def frame_received(self, frame):
+        if self.__callback is not None:
+            self.__callback(frame)
+            return
+
+        self.__frames.append(bytes(frame))
+        self.__wakeup()
+        if len(self.__frames) >= self.max_queued and not self.__paused \
+           and not self.transport.is_closing():
+            self.__paused = True
+            self.transport.pause_reading()
+
+    def send_frame(self, payload):
+        # header and payload are written separately rather than joined
+        self.transport.writelines(
+            [FRAME_HEADER.pack(len(payload)), payload])
+
+    def __wakeup(self):
+        waiter = self.__waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self.__frames:
+            if self.__eof:
+                if self.__exception is not None:
+                    raise self.__exception
+                raise StopAsyncIteration
+            loop = self._loop or asyncio.get_event_loop()
+            self.__waiter = loop.create_future()
+            try:
+                await self.__waiter
+            finally:
+                self.__waiter = None
+
+        frame = self.__frames.popleft()
+        if self.__paused and not self.__eof \
+           and len(self.__frames) <= self.max_queued // 2:
+            self.__paused = False
+            self.transport.resume_reading()
+        return frame
+
 async def create_connection(protocol_factory, host=None, port=None,
-                            local_addr=None, loop=None, debug=False):
+                            local_addr=None, loop=None, debug=False,
+                            **kwargs):
+    # Any extra keyword arguments (capture, time_source, ...) are passed
+    # on to UtpTransport.
     if loop is None:
         loop = asyncio.get_event_loop()
 
     proto = protocol_factory()
-    transport = UtpTransport(loop, proto, host, port, local_addr, debug=debug)
+    transport = UtpTransport(loop, proto, host, port, local_addr, debug=debug,
+                             **kwargs)
     return transport, proto
 
 async def open_connection(host=None, port=None, local_addr=None,
-                          limit=None, loop=None, debug=False):
+                          limit=None, loop=None, debug=False, **kwargs):
     if loop is None:
         loop = asyncio.get_event_loop()
 
@@ -386,7 +2078,7 @@ async def open_connection(host=None, port=None, local_addr=None,
         reader, loop=loop)
     transport, _ = await create_connection(
         lambda: protocol, host, port, local_addr=local_addr,
-        loop=loop, debug=debug)
+        loop=loop, debug=debug, **kwargs)
     writer = asyncio.StreamWriter(transport, protocol, reader, loop)
 
     # Wait for the connection to establish. This is not done in
@@ -400,15 +2092,18 @@ async def open_connection(host=None, port=None, local_addr=None,
     return reader, writer
 
 async def create_server(protocol_factory, host=None, port=None,
-                        loop=None, debug=False):
+                        loop=None, debug=False, **kwargs):
+    # Any extra keyword arguments (capture, time_source, ...) are passed
+    # on to UtpServer.
     if loop is None:
         loop = asyncio.get_event_loop()
 
-    server = UtpServer(protocol_factory, loop, host, port, debug=debug)
+    server = UtpServer(protocol_factory, loop, host, port, debug=debug,
+                       **kwargs)
     return server
 
 async def start_server(client_connected_cb, host=None, port=None,
-                       limit=None, loop=None, debug=False):
+                       limit=None, loop=None, debug=False, **kwargs):
     if loop is None:
         loop = asyncio.get_event_loop()
 
@@ -421,4 +2116,5 @@ async def start_server(client_connected_cb, host=None, port=None,
                                         loop=loop)
         return protocol
 
-    return await create_server(factory, host, port, loop, debug=debug)
+    return await create_server(factory, host, port, loop, debug=debug,
+                               **kwargs)
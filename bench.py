@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+
+import asyncio
+import ctypes
+import socket
+import time
+import argparse
+import aioutp
+import utp
+from sockaddr import to_sockaddr, from_sockaddr
+
+def legacy_callback(func):
+    # Wraps func in a raw callback that decodes its arguments the way
+    # utp.py did before the per-type decoders: every possible argument
+    # tuple is built on each call and addresses are not cached.
+    def callback(cb, ctx, sock, args):
+        if cb in [utp.UTP_ON_FIREWALL, utp.UTP_ON_ACCEPT, utp.UTP_GET_UDP_MTU,
+                  utp.UTP_GET_UDP_OVERHEAD, utp.UTP_SENDTO]:
+            addr = from_sockaddr(args.address.contents)
+        else:
+            addr = None
+
+        if cb in [utp.UTP_ON_READ, utp.UTP_SENDTO]:
+            data = ctypes.string_at(args.buf, args.len)
+        elif cb == utp.UTP_LOG:
+            data = ctypes.string_at(args.buf)
+        else:
+            data = None
+
+        decoded = {
+            utp.UTP_ON_FIREWALL: (cb, ctx, addr),
+            utp.UTP_ON_ACCEPT: (cb, ctx, sock, addr),
+            utp.UTP_ON_CONNECT: (cb, ctx, sock),
+            utp.UTP_ON_ERROR: (cb, ctx, sock, args.error_code),
+            utp.UTP_ON_READ: (cb, ctx, sock, data),
+            utp.UTP_ON_OVERHEAD_STATISTICS: (cb, ctx, sock,
+                                             args.send, args.len, args.type),
+            utp.UTP_ON_STATE_CHANGE: (cb, ctx, sock, args.state),
+            utp.UTP_GET_READ_BUFFER_SIZE: (cb, ctx, sock),
+            utp.UTP_ON_DELAY_SAMPLE: (cb, ctx, sock),
+            utp.UTP_GET_UDP_MTU: (cb, ctx, sock, addr),
+            utp.UTP_GET_UDP_OVERHEAD: (cb, ctx, sock, addr),
+            utp.UTP_GET_MILLISECONDS: (cb, ctx, sock),
+            utp.UTP_GET_MICROSECONDS: (cb, ctx, sock),
+            utp.UTP_GET_RANDOM: (cb, ctx, sock),
+            utp.UTP_LOG: (cb, ctx, sock, data),
+            utp.UTP_SENDTO: (cb, ctx, sock, data, addr, args.flags)
+        }[cb]
+        return func(*decoded)
+    return callback
+
+class Peer:
+    def __init__(self, loop, offload, io_mode, legacy=False):
+        self._loop = loop
+        self.udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_sock.setblocking(0)
+        self.udp_sock.bind(('127.0.0.1', 0))
+        self.ctx = utp.utp_init(2)
+        self.endpoint = aioutp.make_endpoint(io_mode, loop, self.udp_sock,
+                                             self.ctx, self.udp_error,
+                                             offload=offload)
+        self.sock = None
+        self.received = 0
+        self.packets_out = 0
+        self.on_writable = None
+        self.on_read = None
+
+        callbacks = [
+            (utp.UTP_SENDTO, self.sendto_cb),
+            (utp.UTP_ON_STATE_CHANGE, self.state_change_cb),
+            (utp.UTP_ON_READ, self.read_cb),
+            (utp.UTP_ON_ACCEPT, self.accept_cb),
+        ]
+        for callback_type, func in callbacks:
+            if legacy:
+                utp.utp_set_callback(self.ctx, callback_type,
+                                     legacy_callback(func), raw=True)
+            else:
+                utp.utp_set_callback(self.ctx, callback_type, func)
+
+        self.legacy = legacy
+        if legacy:
+            loop.add_reader(self.udp_sock, self.legacy_read)
+        else:
+            self.endpoint.start_reading()
+        self.check_timeouts()
+
+    def legacy_read(self):
+        # The receive loop from before the preallocated buffer: a new
+        # bytes object and a new sockaddr struct for every datagram.
+        while True:
+            try:
+                data, addr = self.udp_sock.recvfrom(1500, socket.MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                break
+            sockaddr, addrlen = to_sockaddr(socket.AF_INET, addr)
+            utp.libutp.utp_process_udp(self.ctx, data, len(data),
+                                       ctypes.byref(sockaddr), addrlen.value)
+        utp.utp_issue_deferred_acks(self.ctx)
+
+    def udp_error(self, exc):
+        raise exc
+
+    def sendto_cb(self, cb, ctx, sock, data, addr, flags):
+        self.packets_out += 1
+        self.endpoint.send(data, addr)
+
+    def state_change_cb(self, cb, ctx, sock, state):
+        if state in (utp.UTP_STATE_CONNECT, utp.UTP_STATE_WRITABLE):
+            if self.on_writable:
+                self._loop.call_soon(self.on_writable)
+
+    def read_cb(self, cb, ctx, sock, data):
+        self.received += len(data)
+        utp.utp_read_drained(sock)
+        if self.on_read:
+            self.on_read()
+
+    def accept_cb(self, cb, ctx, sock, addr):
+        self.sock = sock
+
+    def check_timeouts(self):
+        if self.ctx is None:
+            return
+        utp.utp_check_timeouts(self.ctx)
+        self._loop.call_later(0.05, self.check_timeouts)
+
+    def close(self):
+        if self.sock:
+            utp.utp_close(self.sock)
+        if self.legacy:
+            self._loop.remove_reader(self.udp_sock)
+        self.endpoint.close()
+        utp.utp_destroy(self.ctx)
+        self.ctx = None
+
+async def run(size, chunk_size, offload, io_mode, legacy=False):
+    loop = asyncio.get_running_loop()
+    server = Peer(loop, offload, io_mode, legacy)
+    client = Peer(loop, offload, io_mode, legacy)
+    done = loop.create_future()
+
+    chunk = b'x' * chunk_size
+    sent = 0
+    def write():
+        nonlocal sent
+        while sent < size:
+            data = chunk if size - sent >= chunk_size else chunk[:size - sent]
+            n = utp.utp_write(client.sock, data)
+            if n == 0:
+                break
+            sent += n
+
+    def read():
+        if server.received >= size and not done.done():
+            done.set_result(None)
+
+    client.on_writable = write
+    server.on_read = read
+
+    client.sock = utp.utp_create_socket(client.ctx)
+    utp.utp_connect(client.sock, server.udp_sock.getsockname())
+
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    await done
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+
+    gso = client.endpoint.gso
+    gro = server.endpoint.gro
+    packets = client.packets_out + server.packets_out
+    client.close()
+    server.close()
+
+    return {
+        'bytes': server.received,
+        'elapsed': elapsed,
+        'cpu': cpu,
+        'packets': packets,
+        'gso': gso,
+        'gro': gro,
+    }
+
+def make_runner(name):
+    # Returns a function that runs a coroutine to completion on a new
+    # event loop of the given kind, or None if it's not available.
+    if name == 'asyncio':
+        return asyncio.run
+    try:
+        import uvloop
+    except ImportError:
+        return None
+    def run_uvloop(coro):
+        loop = uvloop.new_event_loop()
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            loop.close()
+    return run_uvloop
+
+def report(name, result):
+    elapsed = result['elapsed']
+    gigabytes = result['bytes'] / 2**30
+    print('{}: {:.2f} MiB in {:.3f}s, {:.2f} MiB/s, {:.0f} packets/s, '
+          '{:.2f} CPU s/GiB'.format(
+              name, result['bytes'] / 2**20, elapsed,
+              result['bytes'] / 2**20 / elapsed,
+              result['packets'] / elapsed,
+              result['cpu'] / gigabytes))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Loopback throughput benchmark for pyutp.')
+
+    parser.add_argument('--size', '-s', type=int, default=64,
+                        help='Amount of data to transfer, in MiB. '
+                        'Defaults to 64.')
+    parser.add_argument('--chunk-size', '-c', type=int, default=65536,
+                        help='Size of each write, in bytes. '
+                        'Defaults to 65536.')
+    parser.add_argument('--repeat', '-r', type=int, default=1,
+                        help='Number of times to run the benchmark.')
+    parser.add_argument('--offload', '-O', action='store_true',
+                        help='Also run with UDP GSO/GRO enabled and '
+                        'compare.')
+    parser.add_argument('--loop', '-l', default='asyncio',
+                        choices=['asyncio', 'uvloop', 'all'],
+                        help='Event loop to run on. "all" compares all of '
+                        'the installed ones. Defaults to asyncio.')
+    parser.add_argument('--io', '-i', default='reader',
+                        choices=['reader', 'datagram', 'all'],
+                        help='How the UDP sockets are driven: add_reader/'
+                        'add_writer, or create_datagram_endpoint. "all" '
+                        'compares both. Defaults to reader.')
+    parser.add_argument('--path', '-p', default='all',
+                        choices=['current', 'legacy', 'all'],
+                        help='Callback decoding and UDP receive path: the '
+                        'current one, the legacy one it replaced (per-call '
+                        'argument tuples, unbuffered recvfrom, uncached '
+                        'addresses), or "all" to compare both in the same '
+                        'run. The legacy path only applies to the reader '
+                        'I/O mode. Defaults to all.')
+
+    args = parser.parse_args()
+
+    loops = ['asyncio', 'uvloop'] if args.loop == 'all' else [args.loop]
+    io_modes = ['reader', 'datagram'] if args.io == 'all' else [args.io]
+    offload_modes = [False, True] if args.offload else [False]
+    paths = ['legacy', 'current'] if args.path == 'all' else [args.path]
+
+    runners = {}
+    for name in loops:
+        runner = make_runner(name)
+        if runner is None:
+            print('{} is not installed; skipping.'.format(name))
+        else:
+            runners[name] = runner
+
+    for i in range(args.repeat):
+        for loop_name, runner in runners.items():
+            for io_mode in io_modes:
+                for offload in offload_modes:
+                    if offload and io_mode != 'reader':
+                        continue
+                    results = {}
+                    for path in paths:
+                        legacy = path == 'legacy'
+                        if legacy and (offload or io_mode != 'reader'):
+                            continue
+                        result = runner(run(args.size * 2**20,
+                                            args.chunk_size, offload,
+                                            io_mode, legacy))
+                        name = '{}/{}/{}'.format(loop_name, io_mode, path)
+                        if offload:
+                            name += ' (gso: {}, gro: {})'.format(
+                                'on' if result['gso'] else 'off',
+                                'on' if result['gro'] else 'off')
+                        report(name, result)
+                        results[path] = result
+                    if len(results) == 2:
+                        before, after = (
+                            results[p]['packets'] / results[p]['elapsed']
+                            for p in ('legacy', 'current'))
+                        print('{}/{}: current path {:+.1f}% packets/s over '
+                              'legacy'.format(loop_name, io_mode,
+                                              (after / before - 1) * 100))
+
+if __name__ == '__main__':
+    main()
@@ -56,8 +56,31 @@ def from_sockaddr(sockaddr):
     if sockaddr.sa_family == socket.AF_UNIX:
         return sockaddr.sun_path
     elif sockaddr.sa_family == socket.AF_INET:
-        addr = tuple(signed_to_unsigned(c) for c in sockaddr.sin_addr)
-        return ('%d.%d.%d.%d' % addr,
+        return (socket.inet_ntoa(bytes(sockaddr.sin_addr)),
                 socket.ntohs(sockaddr.sin_port))
     raise NotImplementedError('Not implemented family %s' %
                               (sockaddr.sa_family,))
+
+# Converted AF_INET addresses, keyed by the raw family, port and
+# address bytes of the struct. Only used by from_sockaddr_ptr.
+_inet_cache = {}
+_INET_CACHE_SIZE = 4096
+
+def from_sockaddr_ptr(ptr):
+    """Like from_sockaddr, but takes a pointer to a sockaddr_in and
+    caches the result, since the same few peers are seen over and over
+    again."""
+    key = ctypes.string_at(ptr, 8)
+    try:
+        return _inet_cache[key]
+    except KeyError:
+        pass
+    addr = from_sockaddr(ptr.contents)
+    if sockaddr_family(key) == socket.AF_INET:
+        if len(_inet_cache) >= _INET_CACHE_SIZE:
+            _inet_cache.clear()
+        _inet_cache[key] = addr
+    return addr
+
+def sockaddr_family(raw):
+    return struct.unpack_from('H', raw)[0]
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import collections
+import gc
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+import aioutp
+import utp
+
+def rss():
+    # resident set size in bytes, or None where /proc is not available
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return None
+
+def open_fds():
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return None
+
+class Stats:
+    def __init__(self, server):
+        self.server = server
+        self.start = time.monotonic()
+        self.connections = 0
+        self.completed = 0
+        self.close_timeouts = 0
+        self.bytes = 0
+        self.errors = collections.Counter()
+        self.active = 0
+        self.max_lag = 0.0
+        self.lags = []
+        self.samples = []
+
+    def error(self, exc):
+        self.errors[type(exc).__name__] += 1
+
+    def sample(self):
+        server_transports = self.server.transports
+        current, peak = tracemalloc.get_traced_memory()
+        sample = {
+            'time': time.monotonic() - self.start,
+            'rss': rss(),
+            'traced': current,
+            'traced_peak': peak,
+            'fds': open_fds(),
+            'contexts': len(utp.contexts),
+            'server_transports': len(server_transports or []),
+            'active': self.active,
+            'connections': self.connections,
+            'completed': self.completed,
+            'errors': sum(self.errors.values()),
+            'close_timeouts': self.close_timeouts,
+        }
+        self.samples.append(sample)
+        return sample
+
+async def echo(reader, writer):
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except (ConnectionError, RuntimeError):
+        pass
+    finally:
+        writer.close()
+
+async def connection(stats, port, payload, lifetime, timeout):
+    reader, writer = await asyncio.wait_for(
+        aioutp.open_connection('127.0.0.1', port), timeout)
+    try:
+        deadline = time.monotonic() + lifetime
+        while True:
+            writer.write(payload)
+            await asyncio.wait_for(writer.drain(), timeout)
+            await asyncio.wait_for(reader.readexactly(len(payload)), timeout)
+            stats.bytes += len(payload)
+            if time.monotonic() >= deadline:
+                break
+    finally:
+        writer.close()
+        try:
+            await asyncio.wait_for(writer.transport.wait_closed(), timeout)
+        except asyncio.TimeoutError:
+            # the exchange itself worked; count the connection libutp
+            # never finished tearing down on its own
+            stats.close_timeouts += 1
+
+async def client_slot(stats, port, payload, max_lifetime, timeout, stop):
+    # keep one connection open at a time, reopening as each one ends
+    while not stop.is_set():
+        stats.connections += 1
+        stats.active += 1
+        try:
+            await connection(stats, port, payload,
+                             random.uniform(0, max_lifetime), timeout)
+            stats.completed += 1
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+                ConnectionError, RuntimeError, OSError) as e:
+            stats.error(e)
+        finally:
+            stats.active -= 1
+
+async def monitor_lag(stats, interval, stop):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag = loop.time() - start - interval
+        stats.lags.append(lag)
+        stats.max_lag = max(stats.max_lag, lag)
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def delta(after, before, key):
+    if after[key] is None or before[key] is None:
+        return None
+    return after[key] - before[key]
+
+async def run(args):
+    loop = asyncio.get_running_loop()
+    tracemalloc.start()
+
+    server = await aioutp.start_server(echo, '127.0.0.1', 0)
+    port = server.addresses[0][1]
+    stats = Stats(server)
+
+    gc.collect()
+    baseline = stats.sample()
+
+    stop = asyncio.Event()
+    payload = os.urandom(args.payload)
+    lag_task = loop.create_task(monitor_lag(stats, args.lag_interval, stop))
+    slots = [loop.create_task(client_slot(stats, port, payload,
+                                          args.max_lifetime, args.timeout,
+                                          stop))
+             for i in range(args.connections)]
+
+    deadline = time.monotonic() + args.duration
+    while time.monotonic() < deadline:
+        await asyncio.sleep(min(args.interval, deadline - time.monotonic()))
+        s = stats.sample()
+        print('{:7.1f}s: {} active, {} done, {} errors, {} close timeouts, '
+              'rss {} MiB, {} fds, {} contexts, {} server transports, '
+              'max lag {:.3f}s'.format(
+                  s['time'], s['active'], s['completed'], s['errors'],
+                  s['close_timeouts'],
+                  (s['rss'] or 0) // 2**20, s['fds'], s['contexts'],
+                  s['server_transports'], stats.max_lag),
+              file=sys.stderr)
+
+    stop.set()
+    done, pending = await asyncio.wait(slots, timeout=args.timeout * 4)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    await lag_task
+
+    server.close()
+    try:
+        await asyncio.wait_for(server.wait_closed(), args.timeout)
+    except asyncio.TimeoutError as e:
+        stats.error(e)
+
+    # let libutp finish tearing down the closed sockets
+    await asyncio.sleep(1)
+    gc.collect()
+    final = stats.sample()
+    tracemalloc.stop()
+
+    elapsed = final['time']
+    return {
+        'version': 1,
+        'config': vars(args),
+        'elapsed': elapsed,
+        'connections': stats.connections,
+        'completed': stats.completed,
+        'connections_per_second': stats.completed / elapsed,
+        'bytes': stats.bytes,
+        'errors': dict(stats.errors),
+        'error_rate': (sum(stats.errors.values()) / stats.connections
+                       if stats.connections else 0.0),
+        'close_timeout_rate': (stats.close_timeouts / stats.connections
+                               if stats.connections else 0.0),
+        'lag': {
+            'max': stats.max_lag,
+            'p50': percentile(stats.lags, 0.5),
+            'p99': percentile(stats.lags, 0.99),
+        },
+        'leaks': {
+            'rss': delta(final, baseline, 'rss'),
+            'traced': delta(final, baseline, 'traced'),
+            'fds': delta(final, baseline, 'fds'),
+            'contexts': delta(final, baseline, 'contexts'),
+            'server_transports': final['server_transports'],
+        },
+        'samples': stats.samples,
+    }
+
+def summarize(report):
+    # the figures compared between runs, flattened
+    summary = {
+        'connections_per_second': report['connections_per_second'],
+        'error_rate': report['error_rate'],
+        'close_timeout_rate': report.get('close_timeout_rate'),
+    }
+    for key, value in report['lag'].items():
+        summary['lag_' + key] = value
+    for key, value in report['leaks'].items():
+        summary['leaked_' + key] = value
+    return summary
+
+def print_report(report, old=None):
+    summary = summarize(report)
+    old_summary = summarize(old) if old is not None else {}
+    for key, value in summary.items():
+        line = '{:28} {}'.format(key, value)
+        before = old_summary.get(key)
+        if before is not None and value is not None:
+            line += ' (was {}, {:+})'.format(before, value - before)
+        print(line)
+    if report['errors']:
+        print('errors: {}'.format(', '.join(
+            '{} {}'.format(n, name)
+            for name, n in sorted(report['errors'].items()))))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Churn many concurrent aioutp connections against one '
+        'server over loopback and report on leaks, event loop lag and '
+        'errors.')
+
+    parser.add_argument('--connections', '-n', type=int, default=1000,
+                        help='Number of concurrent connections. '
+                        'Defaults to 1000.')
+    parser.add_argument('--duration', '-t', type=float, default=60,
+                        help='How long to run, in seconds. Defaults to 60.')
+    parser.add_argument('--max-lifetime', '-L', type=float, default=5,
+                        help='Each connection stays open for a random time '
+                        'up to this many seconds. Defaults to 5.')
+    parser.add_argument('--payload', '-p', type=int, default=1024,
+                        help='Size of each echoed message, in bytes. '
+                        'Defaults to 1024.')
+    parser.add_argument('--timeout', type=float, default=10,
+                        help='Timeout for each step of a connection, in '
+                        'seconds. Defaults to 10.')
+    parser.add_argument('--interval', '-i', type=float, default=5,
+                        help='Seconds between samples. Defaults to 5.')
+    parser.add_argument('--lag-interval', type=float, default=0.1,
+                        help='Seconds between event loop lag probes. '
+                        'Defaults to 0.1.')
+    parser.add_argument('--output', '-o',
+                        help='Write the full report as JSON to this file.')
+    parser.add_argument('--compare', '-c', metavar='OLD',
+                        help='Compare against a report written earlier '
+                        'with --output.')
+
+    args = parser.parse_args()
+
+    old = None
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+
+    try:
+        report = asyncio.run(run(args))
+    except KeyboardInterrupt:
+        sys.exit(1)
+
+    print_report(report, old)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+import unittest
+from aioutp import FairQueue, check_io_mode
+
+def drain(queue):
+    rounds = []
+    while queue:
+        out = []
+        queue.pop_round(out)
+        rounds.append(out)
+    return rounds
+
+class FairQueueTest(unittest.TestCase):
+    def test_empty(self):
+        queue = FairQueue()
+        self.assertFalse(queue)
+        out = []
+        self.assertEqual(queue.pop_round(out), 0)
+        self.assertEqual(out, [])
+
+    def test_round_robin(self):
+        queue = FairQueue(quantum=100)
+        for i in range(3):
+            queue.push('a', 'a{}'.format(i), 100)
+        queue.push('b', 'b0', 100)
+        self.assertTrue(queue)
+        self.assertEqual(drain(queue), [['a0', 'b0'], ['a1'], ['a2']])
+
+    def test_weights(self):
+        queue = FairQueue(quantum=100)
+        for i in range(4):
+            queue.push('a', 'a{}'.format(i), 100)
+            queue.push('b', 'b{}'.format(i), 100, weight=3)
+        self.assertEqual(drain(queue), [['a0', 'b0', 'b1', 'b2'],
+                                        ['a1', 'b3'], ['a2'], ['a3']])
+
+    def test_large_datagram_accrues_deficit(self):
+        queue = FairQueue(quantum=100)
+        queue.push('a', 'big', 250)
+        queue.push('b', 'b0', 100)
+        queue.push('b', 'b1', 100)
+        queue.push('b', 'b2', 100)
+        self.assertEqual(drain(queue), [['b0'], ['b1'], ['big', 'b2']])
+
+    def test_idle_flow_loses_deficit(self):
+        queue = FairQueue(quantum=100)
+        queue.push('a', 'a0', 10)
+        self.assertEqual(drain(queue), [['a0']])
+        # the 90 bytes left over are not carried into the next burst
+        queue.push('a', 'a1', 150)
+        queue.push('b', 'b0', 100)
+        queue.push('b', 'b1', 100)
+        self.assertEqual(drain(queue), [['b0'], ['a1', 'b1']])
+
+    def test_bad_weight(self):
+        queue = FairQueue()
+        for weight in (0, -1):
+            with self.assertRaises(ValueError):
+                queue.push('a', 'a0', 100, weight=weight)
+        self.assertFalse(queue)
+
+class CheckIoModeTest(unittest.TestCase):
+    def test_datagram_options(self):
+        check_io_mode('reader', offload=True, drop_stats=True,
+                      fair_queue=True)
+        check_io_mode('datagram')
+        for option in ('offload', 'drop_stats', 'fair_queue'):
+            with self.assertRaises(ValueError):
+                check_io_mode('datagram', **{option: True})
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            check_io_mode('poll')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import asyncio
+import unittest
+from aioutp import FRAME_HEADER, FramedProtocol
+
+def frame(payload):
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+class FakeTransport:
+    def __init__(self):
+        self.written = []
+        self.closed = False
+        self.paused = False
+
+    def writelines(self, data):
+        self.written.extend(bytes(d) for d in data)
+
+    def close(self):
+        self.closed = True
+
+    def is_closing(self):
+        return self.closed
+
+    def pause_reading(self):
+        self.paused = True
+
+    def resume_reading(self):
+        self.paused = False
+
+class FramedProtocolTest(unittest.TestCase):
+    def setUp(self):
+        self.frames = []
+        self.transport = FakeTransport()
+        self.protocol = FramedProtocol(
+            lambda f: self.frames.append(bytes(f)))
+        self.protocol.connection_made(self.transport)
+
+    def test_several_frames_in_one_read(self):
+        self.protocol.data_received(frame(b'a') + frame(b'') + frame(b'bc'))
+        self.assertEqual(self.frames, [b'a', b'', b'bc'])
+
+    def test_frame_split_across_reads(self):
+        data = frame(b'hello') + frame(b'world')
+        for i in range(len(data)):
+            self.protocol.data_received(data[i:i + 1])
+        self.assertEqual(self.frames, [b'hello', b'world'])
+
+    def test_partial_header(self):
+        data = frame(b'x' * 300)
+        self.protocol.data_received(data[:2])
+        self.protocol.data_received(data[2:7])
+        self.assertEqual(self.frames, [])
+        self.protocol.data_received(data[7:] + frame(b'y')[:3])
+        self.assertEqual(self.frames, [b'x' * 300])
+        self.protocol.data_received(frame(b'y')[3:])
+        self.assertEqual(self.frames, [b'x' * 300, b'y'])
+
+    def test_frame_too_large(self):
+        self.protocol.max_frame_size = 4
+        self.protocol.data_received(frame(b'12345') + frame(b'1'))
+        self.assertEqual(self.frames, [])
+        self.assertTrue(self.transport.closed)
+        # nothing is parsed after the error
+        self.protocol.data_received(frame(b'1'))
+        self.assertEqual(self.frames, [])
+
+    def test_send_frame(self):
+        self.protocol.send_frame(b'abc')
+        self.assertEqual(b''.join(self.transport.written), frame(b'abc'))
+
+class FramedProtocolIterTest(unittest.TestCase):
+    def test_async_iteration(self):
+        async def run():
+            transport = FakeTransport()
+            protocol = FramedProtocol(max_queued=2)
+            protocol.connection_made(transport)
+            protocol.data_received(frame(b'1') + frame(b'2') + frame(b'3'))
+            self.assertTrue(transport.paused)
+            frames = [await protocol.__anext__(), await protocol.__anext__()]
+            self.assertFalse(transport.paused)
+            protocol.connection_lost(None)
+            frames += [f async for f in protocol]
+            return frames
+
+        self.assertEqual(asyncio.run(run()), [b'1', b'2', b'3'])
+
+    def test_error_raised_after_queued_frames(self):
+        async def run():
+            protocol = FramedProtocol()
+            protocol.connection_made(FakeTransport())
+            protocol.data_received(frame(b'1'))
+            protocol.connection_lost(ConnectionResetError())
+            self.assertEqual(await protocol.__anext__(), b'1')
+            with self.assertRaises(ConnectionResetError):
+                await protocol.__anext__()
+
+        asyncio.run(run())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import ctypes
+import threading
+import types
+import unittest
+from utpsocket import RingBuffer, UtpSocket
+
+def write(ring, data):
+    buf = ctypes.create_string_buffer(data, len(data))
+    ring.write_from(buf, len(data))
+
+def read(ring, n):
+    out = bytearray(n)
+    n = ring.read_into(memoryview(out))
+    return bytes(out[:n])
+
+class RingBufferTest(unittest.TestCase):
+    def test_read_write(self):
+        ring = RingBuffer(8)
+        write(ring, b'abc')
+        self.assertEqual(ring.len, 3)
+        self.assertEqual(read(ring, 2), b'ab')
+        self.assertEqual(read(ring, 10), b'c')
+        self.assertEqual(ring.len, 0)
+        self.assertEqual(read(ring, 10), b'')
+
+    def test_wrap_around(self):
+        ring = RingBuffer(8)
+        write(ring, b'012345')
+        self.assertEqual(read(ring, 5), b'01234')
+        # written across the end of the buffer
+        write(ring, b'abcdef')
+        self.assertEqual(ring.size, 8)
+        self.assertEqual(ring.len, 7)
+        self.assertEqual(read(ring, 7), b'5abcdef')
+
+    def test_grow(self):
+        ring = RingBuffer(8)
+        write(ring, b'012345')
+        self.assertEqual(read(ring, 4), b'0123')
+        write(ring, b'abcdefghijklmnopq')
+        self.assertEqual(ring.size, 32)
+        self.assertEqual(ring.start, 0)
+        self.assertEqual(read(ring, 32), b'45abcdefghijklmnopq')
+
+    def test_grow_wrapped(self):
+        ring = RingBuffer(4)
+        write(ring, b'abc')
+        read(ring, 2)
+        write(ring, b'def')
+        # c, d at the end of the buffer and e, f wrapped to the front
+        write(ring, b'ghi')
+        self.assertEqual(ring.size, 8)
+        self.assertEqual(read(ring, 8), b'cdefghi')
+
+class UtpSocketSendTest(unittest.TestCase):
+    def test_empty_send(self):
+        context = types.SimpleNamespace(lock=threading.RLock(), sockets={})
+        sock = UtpSocket(context, _sock=1, _peername=('127.0.0.1', 1))
+        # returns straight away, without calling libutp
+        self.assertEqual(sock.send(b''), 0)
+        self.assertEqual(sock.send(bytearray()), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import unittest
+from aioutp import TokenBucket
+
+class FakeLoop:
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+class TokenBucketTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = FakeLoop()
+        self.bucket = TokenBucket(self.loop, 1000, burst=500)
+
+    def test_default_burst(self):
+        self.assertEqual(TokenBucket(self.loop, 1000).burst, 16 * 1024)
+        self.assertEqual(TokenBucket(self.loop, 10**7).burst, 500000)
+
+    def test_consume_and_refill(self):
+        self.assertTrue(self.bucket.consume(300))
+        self.assertFalse(self.bucket.consume(300))
+        self.assertAlmostEqual(self.bucket.delay(300), 0.1)
+        self.loop.now += 0.1
+        self.assertEqual(self.bucket.delay(300), 0)
+        self.assertTrue(self.bucket.consume(300))
+
+    def test_refill_capped_at_burst(self):
+        self.loop.now += 10
+        self.assertTrue(self.bucket.consume(500))
+        self.assertFalse(self.bucket.consume(1))
+
+    def test_oversized_consume_goes_into_debt(self):
+        self.assertTrue(self.bucket.consume(800))
+        self.assertEqual(self.bucket.tokens, -300)
+        self.assertAlmostEqual(self.bucket.delay(800), 0.8)
+
+    def test_take_and_refund(self):
+        self.assertEqual(self.bucket.take(800), 500)
+        self.assertEqual(self.bucket.take(1), 0)
+        self.bucket.refund(200)
+        self.assertEqual(self.bucket.take(800), 200)
+
+    def test_set_rate(self):
+        self.bucket.consume(500)
+        self.loop.now += 0.1
+        # the 100 tokens accrued at the old rate are kept
+        self.bucket.set_rate(2000, burst=150)
+        self.assertEqual(self.bucket.tokens, 100)
+        self.assertEqual(self.bucket.burst, 150)
+        self.loop.now += 0.1
+        self.assertEqual(self.bucket.take(1000), 150)
+
+    def test_invalid_rate(self):
+        for rate in (0, -1):
+            with self.assertRaises(ValueError):
+                TokenBucket(self.loop, rate)
+            with self.assertRaises(ValueError):
+                self.bucket.set_rate(rate)
+        with self.assertRaises(ValueError):
+            TokenBucket(self.loop, 1000, burst=0)
+        with self.assertRaises(ValueError):
+            self.bucket.set_rate(1000, burst=-1)
+        # a failed set_rate leaves the bucket as it was
+        self.assertEqual((self.bucket.rate, self.bucket.burst), (1000, 500))
+
+if __name__ == '__main__':
+    unittest.main()
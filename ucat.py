@@ -4,9 +4,12 @@ import socket
 import select
 import sys
 import os
+import time
+import ctypes
 import logging
 import argparse
 import utp
+from collections import deque
 
 keep_running = True
 writable = False
@@ -17,11 +20,24 @@ sock_fd = None
 ctx = None
 sock = None
 exit_code = 0
-data_buffer = b''
+bulk = False
+stdin_eof = False
+bytes_sent = 0
+bytes_received = 0
+
+# data read from stdin that libutp hasn't accepted yet, as (buffer,
+# offset) pairs
+pending = deque()
+pending_size = 0
+
+# In bulk mode, stop reading stdin while this much data is pending.
+MAX_PENDING = 4 * 1024 * 1024
 
 def sendto_cb(cb, ctx, sock, data, addr, flags):
     addr, port = addr
-    logger.debug('sending {} byte(s) to {}:{}'.format(len(data), addr, port))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('sending {} byte(s) to {}:{}'.format(len(data), addr,
+                                                          port))
     s.sendto(data, (addr, port))
     return 0
 
@@ -61,7 +77,13 @@ def error_cb(cb, ctx, sock, error_code):
     return 0
 
 def read_cb(cb, ctx, sock, data):
-    print(data.decode(), end='')
+    global bytes_received
+
+    bytes_received += len(data)
+    if bulk:
+        sys.stdout.buffer.write(data)
+    else:
+        print(data.decode(), end='')
     utp.utp_read_drained(sock)
     return 0
 
@@ -94,30 +116,43 @@ def log_cb(cb, ctx, sock, msg):
     return 0
 
 def write_data():
-    global keep_running, sock, data_buffer
+    global writable, pending_size, bytes_sent, sock
     if not writable and not (listen_mode and sock):
         logger.warning('Socket not writable.')
         return
 
-    sent = 0
-    while sent < len(data_buffer):
-        sent = utp.utp_write(sock, data_buffer)
-        if sent == 0:
-            print('Socket no longer writable.')
-            keep_running = False
-            if sock:
-                utp.utp_close(sock)
-            sock = None
-            exit_code = 0
+    while pending:
+        data, offset = pending[0]
+        sent = utp.utp_write(sock, data, offset)
+        pending_size -= sent
+        bytes_sent += sent
+        if offset + sent < len(data):
+            # libutp's send buffer is full; wait for UTP_STATE_WRITABLE
+            pending[0] = (data, offset + sent)
+            writable = False
             return
-        data_buffer = data_buffer[sent:]
+        pending.popleft()
+
+    if bulk and stdin_eof and sock and bytes_sent:
+        # Everything has been handed to libutp; close gracefully and
+        # exit once the socket is destroyed. A side that had nothing to
+        # send keeps receiving until the peer closes.
+        logger.debug('Send buffer flushed; closing.')
+        utp.utp_close(sock)
+        sock = None
 
 def network_loop():
-    global keep_running, data_buffer
+    global keep_running, stdin_eof, pending_size
+
+    buf = bytearray(65536)
+    cbuf = (ctypes.c_char * len(buf)).from_buffer(buf)
+    chunk_size = 256 * 1024 if bulk else 2000
+    stdin_fd = sys.stdin.fileno()
+    reading_stdin = True
 
     poll = select.poll()
     poll.register(sock_fd, select.POLLIN)
-    poll.register(sys.stdin.fileno(), select.POLLIN)
+    poll.register(stdin_fd, select.POLLIN)
     while keep_running:
         results = poll.poll(100)
         for fd, ev in results:
@@ -125,7 +160,7 @@ def network_loop():
                 drained = False
                 while not drained:
                     try:
-                        data, addr = s.recvfrom(1500, socket.MSG_DONTWAIT)
+                        n, addr = s.recvfrom_into(buf, 0, socket.MSG_DONTWAIT)
                     except socket.error as e:
                         if e.errno == socket.EAGAIN or e.errno == socket.EWOULDBLOCK:
                             logger.debug('Issuing deferred acks.')
@@ -135,22 +170,39 @@ def network_loop():
                             logger.error(e)
                             exit(1)
                     else:
-                        utp.utp_process_udp(ctx, data, addr)
-            elif fd == sys.stdin.fileno():
-                data = os.read(sys.stdin.fileno(), 2000)
+                        utp.utp_process_udp(ctx, cbuf, addr, n)
+            elif fd == stdin_fd:
+                data = os.read(stdin_fd, chunk_size)
                 if data == b'':
                     logger.debug('EOF from stdin.')
                     poll.unregister(fd)
-                    os.close(sys.stdin.fileno())
-                    keep_running = False
+                    os.close(stdin_fd)
+                    reading_stdin = False
+                    stdin_eof = True
+                    if bulk:
+                        if sock and not pending:
+                            write_data()
+                    else:
+                        keep_running = False
                 else:
-                    data_buffer += data
-                    write_data()
+                    pending.append((data, 0))
+                    pending_size += len(data)
+                    if sock:
+                        write_data()
+
+        if bulk and not stdin_eof:
+            # don't read more than the network can take
+            if reading_stdin and pending_size > MAX_PENDING:
+                poll.unregister(stdin_fd)
+                reading_stdin = False
+            elif not reading_stdin and pending_size <= MAX_PENDING // 2:
+                poll.register(stdin_fd, select.POLLIN)
+                reading_stdin = True
 
         utp.utp_check_timeouts(ctx)
 
 def main():
-    global s, sock_fd, ctx, sock, logger, listen_mode, exit_code
+    global s, sock_fd, ctx, sock, logger, listen_mode, exit_code, bulk
 
     parser = argparse.ArgumentParser(
         description='netcat-like utility using uTP as the transport protocol.')
@@ -176,6 +228,11 @@ def main():
         help='Minimum level of the logged messages.')
     parser.add_argument('--log-to-stdout', '-o', action='store_true',
                         help='Write log messages to standard output.')
+    parser.add_argument('--bulk', '-B', action='store_true',
+                        help='Bulk transfer mode: stream standard input '
+                        'in large chunks, write received data to standard '
+                        'output as-is, and report the throughput on '
+                        'standard error when done.')
 
     args = parser.parse_args()
 
@@ -189,6 +246,8 @@ def main():
     if args.listen:
         listen_mode = True
 
+    bulk = args.bulk
+
     if args.debug:
         args.log_level = 'debug'
 
@@ -245,6 +304,7 @@ def main():
         sock = utp.utp_create_socket(ctx);
         ret = utp.utp_connect(sock, (args.dest_host, args.dest_port))
 
+    start = time.monotonic()
     try:
         network_loop()
     except KeyboardInterrupt:
@@ -252,11 +312,20 @@ def main():
         if sock:
             utp.utp_close(sock)
             sock = None
+    elapsed = time.monotonic() - start
 
-    if data_buffer != b'':
+    if pending:
         logger.warning('Send buffer not empty.')
         exit_code = 1
 
+    if bulk:
+        sys.stdout.buffer.flush()
+        total = max(bytes_sent, bytes_received)
+        print('Sent {} bytes, received {} bytes in {:.3f}s ({:.2f} MiB/s)'
+              .format(bytes_sent, bytes_received, elapsed,
+                      total / 2**20 / elapsed if elapsed else 0),
+              file=sys.stderr)
+
     utp.utp_destroy(ctx)
 
     exit(exit_code)
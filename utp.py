@@ -1,7 +1,10 @@
+import os
+import sys
+import time
 import ctypes
 import socket
 from ctypes import cdll, c_int, c_void_p, c_uint, c_uint32, c_uint64, c_size_t, c_ssize_t, c_char, c_char_p, POINTER, CFUNCTYPE
-from sockaddr import to_sockaddr, from_sockaddr, sockaddr_in
+from sockaddr import to_sockaddr, from_sockaddr_ptr, sockaddr_in
 
 # callbacks
 UTP_ON_FIREWALL = 0
@@ -35,8 +38,16 @@ UTP_SNDBUF = 19
 UTP_RCVBUF = 20
 UTP_TARGET_DELAY = 21
 
+# bandwidth types (on_overhead_statistics)
+PAYLOAD_BANDWIDTH = 0
+CONNECT_OVERHEAD = 1
+CLOSE_OVERHEAD = 2
+ACK_OVERHEAD = 3
+HEADER_OVERHEAD = 4
+RETRANSMIT_OVERHEAD = 5
+
 # errors
-UTP_ECONNREFUSED = 0,
+UTP_ECONNREFUSED = 0
 UTP_ECONNRESET = 1
 UTP_ETIMEDOUT = 2
 
@@ -60,137 +71,415 @@ class UtpCallbackArgs(ctypes.Structure):
                 ('anon1', _U1),
                 ('anon2', _U2)]
 
-libutp = cdll.LoadLibrary('libutp.so')
-
 CBFUNC = CFUNCTYPE(c_uint64, POINTER(UtpCallbackArgs))
-user_callbacks = {}
+
+# registered callbacks, per context: {ctx: {callback_type: (decoder, func)}}
+contexts = {}
+
+def _addr(args):
+    return from_sockaddr_ptr(args.address)
+
+# Each decoder unpacks the relevant fields for one callback type and
+# calls the user function. These are looked up once, when the callback
+# is registered, so the trampoline does no per-call type checks.
+decoders = {
+    UTP_ON_FIREWALL:
+        lambda f, a: f(UTP_ON_FIREWALL, a.context, _addr(a)),
+    UTP_ON_ACCEPT:
+        lambda f, a: f(UTP_ON_ACCEPT, a.context, a.socket, _addr(a)),
+    UTP_ON_CONNECT:
+        lambda f, a: f(UTP_ON_CONNECT, a.context, a.socket),
+    UTP_ON_ERROR:
+        lambda f, a: f(UTP_ON_ERROR, a.context, a.socket, a.error_code),
+    UTP_ON_READ:
+        lambda f, a: f(UTP_ON_READ, a.context, a.socket,
+                       ctypes.string_at(a.buf, a.len)),
+    UTP_ON_OVERHEAD_STATISTICS:
+        lambda f, a: f(UTP_ON_OVERHEAD_STATISTICS, a.context, a.socket,
+                       a.send, a.len, a.type),
+    UTP_ON_STATE_CHANGE:
+        lambda f, a: f(UTP_ON_STATE_CHANGE, a.context, a.socket, a.state),
+    UTP_GET_READ_BUFFER_SIZE:
+        lambda f, a: f(UTP_GET_READ_BUFFER_SIZE, a.context, a.socket),
+    UTP_ON_DELAY_SAMPLE:
+        lambda f, a: f(UTP_ON_DELAY_SAMPLE, a.context, a.socket, a.sample_ms),
+    UTP_GET_UDP_MTU:
+        lambda f, a: f(UTP_GET_UDP_MTU, a.context, a.socket, _addr(a)),
+    UTP_GET_UDP_OVERHEAD:
+        lambda f, a: f(UTP_GET_UDP_OVERHEAD, a.context, a.socket, _addr(a)),
+    UTP_GET_MILLISECONDS:
+        lambda f, a: f(UTP_GET_MILLISECONDS, a.context, a.socket),
+    UTP_GET_MICROSECONDS:
+        lambda f, a: f(UTP_GET_MICROSECONDS, a.context, a.socket),
+    UTP_GET_RANDOM:
+        lambda f, a: f(UTP_GET_RANDOM, a.context, a.socket),
+    # zero terminated string
+    UTP_LOG:
+        lambda f, a: f(UTP_LOG, a.context, a.socket, ctypes.string_at(a.buf)),
+    UTP_SENDTO:
+        lambda f, a: f(UTP_SENDTO, a.context, a.socket,
+                       ctypes.string_at(a.buf, a.len), _addr(a), a.flags),
+}
+
+def raw_decoder(f, a):
+    return f(a.callback_type, a.context, a.socket, a)
 
 @CBFUNC
 def utp_callback(a):
     args = a.contents
+    decoder, func = contexts[args.context][args.callback_type]
 
-    func = user_callbacks[args.callback_type]
+    ret = decoder(func, args)
+    if ret is None:
+        return 0
+    try:
+        return int(ret)
+    except TypeError:
+        return 0
 
-    cb = args.callback_type
-    ctx = args.context
-    sock = args.socket
+# libutp copies the address passed to utp_process_udp, so the converted
+# sockaddr structs can be shared between calls.
+sockaddr_cache = {}
+SOCKADDR_CACHE_SIZE = 4096
 
-    if cb in [UTP_ON_FIREWALL, UTP_ON_ACCEPT, UTP_GET_UDP_MTU,
-              UTP_GET_UDP_OVERHEAD, UTP_SENDTO]:
-        addr = from_sockaddr(args.address.contents)
-    else:
-        addr = None
+def cache_sockaddr(addr):
+    if len(sockaddr_cache) >= SOCKADDR_CACHE_SIZE:
+        sockaddr_cache.clear()
+    sockaddr, addrlen = to_sockaddr(socket.AF_INET, addr)
+    sockaddr_cache[addr] = sockaddr, addrlen.value
+    return sockaddr, addrlen.value
 
-    if cb in [UTP_ON_READ, UTP_SENDTO]:
-        data = ctypes.string_at(args.buf, args.len)
-    elif cb == UTP_LOG:
-        # zero terminated string
-        data = ctypes.string_at(args.buf)
-    else:
-        data = None
-
-    args = {
-        UTP_ON_FIREWALL: (cb, ctx, addr),
-        UTP_ON_ACCEPT: (cb, ctx, sock, addr),
-        UTP_ON_CONNECT: (cb, ctx, sock),
-        UTP_ON_ERROR: (cb, ctx, sock, args.error_code),
-        UTP_ON_READ: (cb, ctx, sock, data),
-        UTP_ON_OVERHEAD_STATISTICS: (cb, ctx, sock,
-                                     args.send, args.len, args.type),
-        UTP_ON_STATE_CHANGE: (cb, ctx, sock, args.state),
-        UTP_GET_READ_BUFFER_SIZE: (cb, ctx, sock),
-        UTP_ON_DELAY_SAMPLE: (cb, ctx, sock),
-        UTP_GET_UDP_MTU: (cb, ctx, sock, addr),
-        UTP_GET_UDP_OVERHEAD: (cb, ctx, sock, addr),
-        UTP_GET_MILLISECONDS: (cb, ctx, sock),
-        UTP_GET_MICROSECONDS: (cb, ctx, sock),
-        UTP_GET_RANDOM: (cb, ctx, sock),
-        UTP_LOG: (cb, ctx, sock, data),
-        UTP_SENDTO: (cb, ctx, sock, data, addr, args.flags)
-    }[args.callback_type]
-
-    ret = func(*args)
-    orig_type = type(ret)
-    try:
-        ret = int(ret)
-    except TypeError:
-        ret = 0
+# The shared library is only loaded when the first context is created
+# (or when load is called explicitly), so that the constants and the
+# pure Python parts of this module can be used without libutp.
+libutp = None
 
-    return ret
+# Environment variable that can be set to the path of the libutp
+# shared object to use.
+LIBUTP_ENV = 'PYUTP_LIBUTP'
+
+# {function name: (argtypes, restype)}
+prototypes = {
+    'utp_init': ([c_int], c_void_p),
+    'utp_destroy': ([c_void_p], None),
+    'utp_set_callback': ([c_void_p, c_int, CBFUNC], None),
+    'utp_create_socket': ([c_void_p], c_void_p),
+    'utp_process_udp': ([c_void_p, POINTER(c_char), c_size_t,
+                         POINTER(sockaddr_in), c_int], c_int),
+    'utp_issue_deferred_acks': ([c_void_p], None),
+    'utp_check_timeouts': ([c_void_p], None),
+    'utp_context_set_option': ([c_void_p, c_int, c_int], c_int),
+    'utp_connect': ([c_void_p, POINTER(sockaddr_in), c_int], c_int),
+    'utp_write': ([c_void_p, c_void_p, c_size_t], c_ssize_t),
+    'utp_read_drained': ([c_void_p], None),
+    'utp_close': ([c_void_p], None),
+}
+
+def find_library():
+    """Return the path of the libutp shared object to load. In order,
+    the PYUTP_LIBUTP environment variable, a libutp.so next to this
+    module, and whatever the system knows as "utp" are tried."""
+    path = os.environ.get(LIBUTP_ENV)
+    if path:
+        return path
+
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'libutp.so')
+    if os.path.exists(path):
+        return path
+
+    import ctypes.util
+    return ctypes.util.find_library('utp') or 'libutp.so'
+
+def load(path=None):
+    """Load libutp from the given path, or the one find_library returns
+    if None. Calling this is optional; the library is loaded when the
+    first context is created otherwise."""
+    global libutp
+
+    if path is None:
+        path = find_library()
+    lib = cdll.LoadLibrary(path)
+    for name, (argtypes, restype) in prototypes.items():
+        func = getattr(lib, name)
+        func.argtypes = argtypes
+        func.restype = restype
+    libutp = lib
+    return lib
 
 # utp_context *utp_init(int version);
-libutp.utp_init.argtypes = [c_int]
-libutp.utp_init.restype = c_void_p
 def utp_init(version):
+    if libutp is None:
+        load()
     return libutp.utp_init(version)
 
 # void utp_destroy(utp_context *ctx);
-libutp.utp_destroy.argtypes = [c_void_p]
 def utp_destroy(ctx):
     libutp.utp_destroy(ctx)
+    contexts.pop(ctx, None)
 
 # void utp_set_callback(utp_context *ctx, int callback_type,
 #                       utp_callback_t *proc);
-libutp.utp_set_callback.argtypes = [c_void_p, c_int, CBFUNC]
-def utp_set_callback(ctx, callback_type, func):
-    user_callbacks[callback_type] = func
+def utp_set_callback(ctx, callback_type, func, raw=False):
+    # With raw=True, func is called as func(cb, ctx, sock, args), where
+    # args is the undecoded UtpCallbackArgs struct. It is only valid
+    # until func returns.
+    callbacks = contexts.setdefault(ctx, {})
+    if raw:
+        decoder = raw_decoder
+    else:
+        decoder = decoders[callback_type]
+    callbacks[callback_type] = (decoder, func)
+    if profile is not None:
+        profile._wrap(ctx, callback_type)
     libutp.utp_set_callback(ctx, callback_type, utp_callback)
 
 # utp_socket *utp_create_socket(utp_context *ctx);
-libutp.utp_create_socket.argtypes = [c_void_p]
-libutp.utp_create_socket.restype = c_void_p
 def utp_create_socket(ctx):
     return libutp.utp_create_socket(ctx)
 
 # int utp_process_udp(utp_context *ctx, const byte *buf, size_t len,
 #                     const struct sockaddr *to, socklen_t tolen);
-libutp.utp_process_udp.argtypes = [c_void_p,
-                                   POINTER(c_char),
-                                   c_size_t,
-                                   POINTER(sockaddr_in),
-                                   c_int]
-libutp.utp_process_udp.restype = c_int
-def utp_process_udp(ctx, data, addr):
-    addr, addrlen = to_sockaddr(socket.AF_INET, addr)
-    return libutp.utp_process_udp(ctx,
-                                  data, c_size_t(len(data)),
-                                  ctypes.byref(addr), addrlen)
+def utp_process_udp(ctx, data, addr, length=None):
+    # data can also be a ctypes char array (e.g. one wrapping a
+    # preallocated receive buffer), in which case length is the number
+    # of valid bytes in it.
+    if length is None:
+        length = len(data)
+    try:
+        addr, addrlen = sockaddr_cache[addr]
+    except KeyError:
+        addr, addrlen = cache_sockaddr(addr)
+    return libutp.utp_process_udp(ctx, data, length, addr, addrlen)
 
 # void utp_issue_deferred_acks(utp_context *ctx);
-libutp.utp_issue_deferred_acks.argtypes = [c_void_p]
 def utp_issue_deferred_acks(ctx):
     libutp.utp_issue_deferred_acks(ctx)
 
 # void utp_check_timeouts(utp_context *ctx);
-libutp.utp_check_timeouts.argtypes = [c_void_p]
 def utp_check_timeouts(ctx):
     libutp.utp_check_timeouts(ctx)
 
 # int utp_context_set_option(utp_context *ctx, int opt, int val);
-libutp.utp_context_set_option.argtypes = [c_void_p, c_int, c_int]
-libutp.utp_context_set_option.restype = c_int
 def utp_context_set_option(ctx, opt, val):
     libutp.utp_context_set_option(ctx, opt, val)
 
 # int utp_connect(utp_socket *s, const struct sockaddr *to, socklen_t tolen);
-libutp.utp_connect.argtypes = [c_void_p, POINTER(sockaddr_in), c_int]
-libutp.utp_connect.restype = c_int
 def utp_connect(sock, dst):
     addr, addrlen = to_sockaddr(socket.AF_INET, dst)
     return libutp.utp_connect(sock, ctypes.byref(addr), addrlen)
 
 # ssize_t utp_write(utp_socket *s, void *buf, size_t count);
-libutp.utp_write.argtypes = [c_void_p, c_void_p, c_size_t]
-libutp.utp_write.restype = c_ssize_t
-def utp_write(sock, buf):
-    return libutp.utp_write(sock, buf, len(buf))
+def utp_write(sock, buf, offset=0, count=None):
+    # buf can be bytes or any writable buffer (e.g. bytearray); only the
+    # part starting at offset (count bytes of it, if given) is written,
+    # without copying it first.
+    if count is None:
+        count = len(buf) - offset
+    if offset == 0 and type(buf) is bytes:
+        return libutp.utp_write(sock, buf, count)
+    if count <= 0:
+        return 0
+    return libutp.utp_write(sock, buffer_address(buf) + offset, count)
+
+def buffer_address(buf):
+    if isinstance(buf, bytes):
+        return ctypes.cast(c_char_p(buf), c_void_p).value
+    return ctypes.addressof(c_char.from_buffer(buf))
 
 # void utp_read_drained(utp_socket *s);
-libutp.utp_read_drained.argtypes = [c_void_p]
 def utp_read_drained(sock):
     libutp.utp_read_drained(sock)
 
 # void utp_close(utp_socket *s);
-libutp.utp_close.argtypes = [c_void_p]
 def utp_close(sock):
     libutp.utp_close(sock)
+
+# Profiling. While a Profile is enabled, the entries in contexts are
+# replaced with timing wrappers and libutp with a proxy that times the
+# calls into it; disabling it puts the originals back, so there is no
+# cost at all when it's off.
+
+# the currently enabled Profile, if any
+profile = None
+
+callback_names = {
+    UTP_ON_FIREWALL: 'on_firewall',
+    UTP_ON_ACCEPT: 'on_accept',
+    UTP_ON_CONNECT: 'on_connect',
+    UTP_ON_ERROR: 'on_error',
+    UTP_ON_READ: 'on_read',
+    UTP_ON_OVERHEAD_STATISTICS: 'on_overhead_statistics',
+    UTP_ON_STATE_CHANGE: 'on_state_change',
+    UTP_GET_READ_BUFFER_SIZE: 'get_read_buffer_size',
+    UTP_ON_DELAY_SAMPLE: 'on_delay_sample',
+    UTP_GET_UDP_MTU: 'get_udp_mtu',
+    UTP_GET_UDP_OVERHEAD: 'get_udp_overhead',
+    UTP_GET_MILLISECONDS: 'get_milliseconds',
+    UTP_GET_MICROSECONDS: 'get_microseconds',
+    UTP_GET_RANDOM: 'get_random',
+    UTP_LOG: 'log',
+    UTP_SENDTO: 'sendto',
+}
+
+# libutp functions timed while profiling
+profiled_functions = ('utp_process_udp', 'utp_check_timeouts', 'utp_write')
+
+class Histogram:
+    """A log-linear histogram of durations in nanoseconds, in the
+    style of HDR histograms: every power of two is split into
+    2**precision linear buckets, so values are kept with a relative
+    error below 2**-precision however large they are."""
+
+    def __init__(self, precision=4):
+        self.precision = precision
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        shift = value.bit_length() - self.precision - 1
+        if shift > 0:
+            value = value >> shift << shift
+        buckets = self.buckets
+        buckets[value] = buckets.get(value, 0) + 1
+
+    def percentile(self, p):
+        # returns the lower bound of the bucket the percentile is in
+        if not self.count:
+            return 0
+        rank = self.count * p / 100
+        seen = 0
+        for value in sorted(self.buckets):
+            seen += self.buckets[value]
+            if seen >= rank:
+                return value
+        return self.max
+
+class ProfiledLibrary:
+    # stands in for the libutp CDLL while profiling
+    def __init__(self, lib, profile):
+        self.__lib = lib
+        for name in profiled_functions:
+            setattr(self, name, self.__timed(getattr(lib, name),
+                                             profile.histogram(name)))
+
+    @staticmethod
+    def __timed(func, histogram):
+        clock = time.perf_counter_ns
+        record = histogram.record
+        def timed(*args):
+            start = clock()
+            ret = func(*args)
+            record(clock() - start)
+            return ret
+        return timed
+
+    def __getattr__(self, name):
+        return getattr(self.__lib, name)
+
+class Profile:
+    """Per-callback-type call counts and latency histograms, and timing
+    of the calls into libutp listed in profiled_functions. Use it as a
+    context manager, or call enable and disable.
+
+    Each callback type gets two histograms: "<name>" covers all of the
+    trampoline's work (decoding the arguments and running the handler),
+    "<name> handler" only the registered Python function. The libutp
+    calls include any callbacks made from them."""
+
+    def __init__(self, precision=4):
+        self.precision = precision
+        self.histograms = {}
+        # (ctx, callback_type) -> (original entry, wrapped entry)
+        self.__wrapped = {}
+        self.__lib = None
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(self.precision)
+        return histogram
+
+    def enable(self):
+        global profile, libutp
+
+        if profile is not None:
+            raise RuntimeError('Profiling is already enabled.')
+        if libutp is None:
+            load()
+        profile = self
+        self.__lib = libutp
+        libutp = ProfiledLibrary(libutp, self)
+        for ctx, callbacks in contexts.items():
+            for callback_type in callbacks:
+                self._wrap(ctx, callback_type)
+
+    def disable(self):
+        global profile, libutp
+
+        if profile is not self:
+            raise RuntimeError('This profile is not enabled.')
+        profile = None
+        libutp = self.__lib
+        self.__lib = None
+        for (ctx, callback_type), (original, wrapped) in \
+                self.__wrapped.items():
+            callbacks = contexts.get(ctx)
+            # leave entries alone that were replaced in the meantime
+            if callbacks is not None and \
+               callbacks.get(callback_type) is wrapped:
+                callbacks[callback_type] = original
+        self.__wrapped.clear()
+
+    def _wrap(self, ctx, callback_type):
+        callbacks = contexts[ctx]
+        decoder, func = original = callbacks[callback_type]
+        name = callback_names.get(callback_type, str(callback_type))
+        clock = time.perf_counter_ns
+        record_callback = self.histogram(name).record
+        record_handler = self.histogram(name + ' handler').record
+
+        def profiled_decoder(f, a):
+            start = clock()
+            ret = decoder(f, a)
+            record_callback(clock() - start)
+            return ret
+
+        def profiled_func(*args):
+            start = clock()
+            ret = func(*args)
+            record_handler(clock() - start)
+            return ret
+
+        wrapped = callbacks[callback_type] = (profiled_decoder, profiled_func)
+        self.__wrapped[ctx, callback_type] = (original, wrapped)
+
+    def dump(self, f=None):
+        """Write a table of the counts and latencies, in microseconds,
+        to f (standard output by default)."""
+        if f is None:
+            f = sys.stdout
+        f.write('{:<32} {:>10} {:>12} {:>9} {:>9} {:>9} {:>9}\n'.format(
+            'name', 'calls', 'total ms', 'p50 us', 'p90 us', 'p99 us',
+            'max us'))
+        for name, h in sorted(self.histograms.items()):
+            if not h.count:
+                continue
+            f.write('{:<32} {:>10} {:>12.3f} {:>9.1f} {:>9.1f} {:>9.1f} '
+                    '{:>9.1f}\n'.format(
+                        name, h.count, h.total / 1e6,
+                        h.percentile(50) / 1e3, h.percentile(90) / 1e3,
+                        h.percentile(99) / 1e3, h.max / 1e3))
+
+    def __enter__(self):
+        self.enable()
+        return self
+
+    def __exit__(self, *exc):
+        self.disable()
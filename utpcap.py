@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+
+import argparse
+import ctypes
+import queue
+import socket
+import struct
+import threading
+import time
+import utp
+
+# A capture file is MAGIC followed by records, each made of a RECORD
+# header and the datagram itself.
+MAGIC = b'UTPCAP\x00\x01'
+
+# timestamp, direction, peer IPv4 address, peer port, datagram length
+RECORD = struct.Struct('<dB4sHI')
+
+RECV = 0
+SEND = 1
+
+# ctx -> Capture, for all contexts currently being captured
+captures = {}
+original_process_udp = None
+
+def capturing_process_udp(ctx, data, addr, length=None):
+    capture = captures.get(ctx)
+    if capture is not None:
+        if capture._queue.full():
+            capture.dropped += 1
+        else:
+            if length is None:
+                packet = bytes(data)
+            else:
+                packet = ctypes.string_at(data, length)
+            capture._put((time.time(), RECV, addr, packet))
+    return original_process_udp(ctx, data, addr, length)
+
+class Capture:
+    """Records every datagram a context receives (through
+    utp_process_udp) and sends (through its UTP_SENDTO callback) to a
+    capture file. Datagrams are queued from the network path and
+    written to disk by a background thread. If the disk can't keep up
+    and more than queue_size datagrams are waiting, new ones are
+    dropped from the capture (not the network) and counted in
+    dropped."""
+
+    def __init__(self, path, buffer_size=1024 * 1024, queue_size=16384):
+        self.path = path
+        self.packets = 0
+        self.dropped = 0
+        self._queue = queue.Queue(queue_size)
+        self._file = open(path, 'wb', buffering=buffer_size)
+        self._file.write(MAGIC)
+        self._contexts = {}
+        self._thread = threading.Thread(target=self.__writer, daemon=True)
+        self._thread.start()
+
+    def __writer(self):
+        write = self._file.write
+        pack = RECORD.pack
+        inet_aton = socket.inet_aton
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+            timestamp, direction, addr, data = record
+            write(pack(timestamp, direction, inet_aton(addr[0]), addr[1],
+                       len(data)))
+            write(data)
+            self.packets += 1
+        self._file.close()
+
+    def attach(self, ctx):
+        """Start capturing ctx. The context's UTP_SENDTO callback must
+        already be set."""
+        global original_process_udp
+
+        if ctx in captures:
+            raise RuntimeError('Context is already being captured.')
+
+        callbacks = utp.contexts[ctx]
+        decoder, sendto = callbacks[utp.UTP_SENDTO]
+        put = self._put
+        def capturing_sendto(cb, ctx, sock, data, addr, flags):
+            put((time.time(), SEND, addr, data))
+            return sendto(cb, ctx, sock, data, addr, flags)
+        callbacks[utp.UTP_SENDTO] = (decoder, capturing_sendto)
+        self._contexts[ctx] = sendto
+
+        captures[ctx] = self
+        if original_process_udp is None:
+            original_process_udp = utp.utp_process_udp
+            utp.utp_process_udp = capturing_process_udp
+
+    def _put(self, record):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def detach(self, ctx):
+        global original_process_udp
+
+        # close() detaches everything, so this may be called again for
+        # a context whose capture has already ended
+        sendto = self._contexts.pop(ctx, None)
+        if sendto is None:
+            return
+        del captures[ctx]
+        callbacks = utp.contexts.get(ctx)
+        if callbacks is not None:
+            decoder, func = callbacks[utp.UTP_SENDTO]
+            callbacks[utp.UTP_SENDTO] = (decoder, sendto)
+
+        if not captures:
+            utp.utp_process_udp = original_process_udp
+            original_process_udp = None
+
+    def close(self):
+        for ctx in list(self._contexts):
+            self.detach(ctx)
+        self._queue.put(None)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def read_capture(path):
+    """Yield (timestamp, direction, addr, data) for every record in the
+    given capture file."""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise RuntimeError('Not a capture file: {}'.format(path))
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                break
+            timestamp, direction, host, port, length = RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                break
+            yield (timestamp, direction, (socket.inet_ntoa(host), port),
+                   data)
+
+def replay(path, speed=1.0):
+    """Feed the datagrams received in a capture into a fresh context,
+    either at their original pace (optionally sped up by the given
+    factor) or, if speed is 0, as fast as possible. Whatever the
+    context sends in response is counted and discarded."""
+    stats = {'received': 0, 'sent': 0, 'read': 0, 'accepted': 0}
+
+    def sendto_cb(cb, ctx, sock, data, addr, flags):
+        stats['sent'] += 1
+
+    def read_cb(cb, ctx, sock, data):
+        stats['read'] += len(data)
+        utp.utp_read_drained(sock)
+
+    def accept_cb(cb, ctx, sock, addr):
+        stats['accepted'] += 1
+
+    ctx = utp.utp_init(2)
+    utp.utp_set_callback(ctx, utp.UTP_SENDTO, sendto_cb)
+    utp.utp_set_callback(ctx, utp.UTP_ON_READ, read_cb)
+    utp.utp_set_callback(ctx, utp.UTP_ON_ACCEPT, accept_cb)
+
+    start = None
+    last_timeout_check = 0
+    for timestamp, direction, addr, data in read_capture(path):
+        if direction != RECV:
+            continue
+        if start is None:
+            start = (timestamp, time.monotonic())
+        if speed > 0:
+            due = start[1] + (timestamp - start[0]) / speed
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        utp.utp_process_udp(ctx, data, addr)
+        stats['received'] += 1
+
+        now = time.monotonic()
+        if now - last_timeout_check > 0.5:
+            utp.utp_issue_deferred_acks(ctx)
+            utp.utp_check_timeouts(ctx)
+            last_timeout_check = now
+
+    utp.utp_issue_deferred_acks(ctx)
+    utp.utp_check_timeouts(ctx)
+    utp.utp_destroy(ctx)
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Inspect and replay pyutp packet captures.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    dump_parser = subparsers.add_parser(
+        'dump', help='Print the records in a capture.')
+    dump_parser.add_argument('file', help='Capture file.')
+
+    replay_parser = subparsers.add_parser(
+        'replay', help='Feed a capture into a fresh context.')
+    replay_parser.add_argument('file', help='Capture file.')
+    replay_parser.add_argument(
+        '--speed', '-s', type=float, default=1.0,
+        help='Replay speed as a multiple of the original. 0 means as fast '
+        'as possible. Defaults to 1.')
+
+    args = parser.parse_args()
+
+    if args.command == 'dump':
+        start = None
+        for timestamp, direction, addr, data in read_capture(args.file):
+            if start is None:
+                start = timestamp
+            print('{:12.6f} {} {}:{} {} bytes'.format(
+                timestamp - start, '<' if direction == RECV else '>',
+                addr[0], addr[1], len(data)))
+    else:
+        stats = replay(args.file, args.speed)
+        print('Replayed {received} datagrams; context sent {sent} datagrams, '
+              'accepted {accepted} connections and read {read} bytes.'.format(
+                  **stats))
+
+if __name__ == '__main__':
+    main()
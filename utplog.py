@@ -0,0 +1,76 @@
+import ctypes
+import logging
+import threading
+import time
+from collections import deque
+
+def parse_log_line(sock, line):
+    """Split a libutp log line into structured fields. Socket level
+    lines look like "<socket> <peer> <conn id> <message>"; anything
+    else is passed through as the message."""
+    parts = line.split(' ', 3)
+    if len(parts) == 4 and parts[0].startswith('0x') and parts[2].isdigit():
+        ptr, peer, conn_id, msg = parts
+        conn_id = int(conn_id)
+    else:
+        peer = conn_id = None
+        msg = line
+    category = 'mtu' if msg.startswith('MTU') else 'utp'
+    return {
+        'utp_socket': sock,
+        'utp_peer': peer,
+        'utp_conn_id': conn_id,
+        'utp_category': category,
+    }, msg
+
+class BufferedLogHandler:
+    """A raw UTP_LOG callback (register it with raw=True) that checks
+    the logger's level before touching the message, keeps the raw bytes
+    in a ring buffer and leaves decoding and emitting them to a
+    background thread. If the buffer fills up faster than it is
+    flushed, the oldest lines are dropped and counted in dropped."""
+
+    def __init__(self, logger, level=logging.DEBUG, size=8192,
+                 flush_interval=0.1):
+        self.logger = logger
+        self.level = level
+        self.dropped = 0
+        self.__records = deque(maxlen=size)
+        self.__flush_interval = flush_interval
+        self.__stop = threading.Event()
+        self.__thread = threading.Thread(target=self.__flusher, daemon=True)
+        self.__thread.start()
+
+    def __call__(self, cb, ctx, sock, args):
+        if not self.logger.isEnabledFor(self.level):
+            return
+        records = self.__records
+        if len(records) == records.maxlen:
+            self.dropped += 1
+        records.append((time.time(), sock, ctypes.string_at(args.buf)))
+
+    def __flusher(self):
+        while not self.__stop.wait(self.__flush_interval):
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        records = self.__records
+        while records:
+            try:
+                created, sock, line = records.popleft()
+            except IndexError:
+                break
+            extra, msg = parse_log_line(
+                sock, line.decode('utf-8', errors='replace'))
+            record = self.logger.makeRecord(
+                self.logger.name, self.level, '(libutp)', 0, 'UTP log: %s',
+                (msg,), None, extra=extra)
+            # keep the time the line was logged, not flushed
+            record.created = created
+            record.msecs = (created - int(created)) * 1000
+            self.logger.handle(record)
+
+    def close(self):
+        self.__stop.set()
+        self.__thread.join()
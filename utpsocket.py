@@ -0,0 +1,483 @@
+import ctypes
+import logging
+import selectors
+import socket
+import threading
+import time
+import utp
+from collections import deque
+
+logger = logging.getLogger('utpsocket')
+
+RECV_BUF_SIZE = 65536
+
+# default size of each socket's receive buffer; libutp is told how full
+# it is, so the peer slows down instead of overflowing it
+RCVBUF_SIZE = 1024 * 1024
+
+# how often utp_check_timeouts is called, in seconds
+TIMEOUT_INTERVAL = 0.5
+
+errors = {
+    utp.UTP_ECONNREFUSED: ConnectionRefusedError,
+    utp.UTP_ECONNRESET: ConnectionResetError,
+    utp.UTP_ETIMEDOUT: TimeoutError,
+}
+
+class RingBuffer:
+    """A fixed-size byte ring buffer that libutp's read buffers are
+    copied straight into. It only grows if more data arrives than it
+    can hold."""
+
+    def __init__(self, size):
+        self.__allocate(size)
+        self.start = 0
+        self.len = 0
+
+    def __allocate(self, size):
+        self.size = size
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.cbuf = (ctypes.c_char * size).from_buffer(self.buf)
+        self.address = ctypes.addressof(self.cbuf)
+
+    def write_from(self, ptr, n):
+        # copy n bytes from a ctypes pointer
+        if self.len + n > self.size:
+            self.__grow(self.len + n)
+        end = (self.start + self.len) % self.size
+        first = min(n, self.size - end)
+        ctypes.memmove(self.address + end, ptr, first)
+        if first < n:
+            ctypes.memmove(self.address,
+                           ctypes.cast(ptr, ctypes.c_void_p).value + first,
+                           n - first)
+        self.len += n
+
+    def read_into(self, view):
+        n = min(len(view), self.len)
+        first = min(n, self.size - self.start)
+        view[:first] = self.view[self.start:self.start + first]
+        view[first:n] = self.view[:n - first]
+        self.start = (self.start + n) % self.size
+        self.len -= n
+        return n
+
+    def __grow(self, needed):
+        size = self.size
+        while size < needed:
+            size *= 2
+        old = RingBuffer.__new__(RingBuffer)
+        old.size, old.view, old.start, old.len = \
+            self.size, self.view, self.start, self.len
+        self.__allocate(size)
+        self.start = 0
+        self.len = old.read_into(self.view)
+
+class Context:
+    """A libutp context and its UDP socket, driven by a background I/O
+    thread. Every libutp call, on any thread, is made with lock held,
+    and the callbacks run with it held too. The thread exits, and the
+    context is destroyed, once close has been called and all of its
+    sockets are gone."""
+
+    def __init__(self, address=('127.0.0.1', 0)):
+        self.lock = threading.RLock()
+        self.sockets = {}
+        self.listener = None
+        self.closing = False
+
+        self.udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_sock.bind(address)
+        self.udp_sock.setblocking(False)
+        self.__wakeup_r, self.__wakeup_w = socket.socketpair()
+        self.__wakeup_r.setblocking(False)
+        # datagrams waiting for the UDP socket to become writable
+        self.__send_buf = deque()
+
+        self.ctx = utp.utp_init(2)
+        utp.utp_set_callback(self.ctx, utp.UTP_SENDTO, self.__sendto_cb)
+        utp.utp_set_callback(self.ctx, utp.UTP_ON_STATE_CHANGE,
+                             self.__state_change_cb)
+        utp.utp_set_callback(self.ctx, utp.UTP_ON_ERROR, self.__error_cb)
+        utp.utp_set_callback(self.ctx, utp.UTP_ON_READ, self.__read_cb,
+                             raw=True)
+        utp.utp_set_callback(self.ctx, utp.UTP_GET_READ_BUFFER_SIZE,
+                             self.__get_read_buffer_size_cb)
+        utp.utp_set_callback(self.ctx, utp.UTP_ON_FIREWALL,
+                             self.__firewall_cb)
+        utp.utp_set_callback(self.ctx, utp.UTP_ON_ACCEPT, self.__accept_cb)
+
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+        self.thread.start()
+
+    def __sendto_cb(self, cb, ctx, sock, data, addr, flags):
+        if self.__send_buf:
+            # keep the datagrams in order
+            self.__send_buf.append((data, addr))
+            return
+        try:
+            self.udp_sock.sendto(data, addr)
+        except BlockingIOError:
+            # The kernel's send buffer is full. Dropping the datagram
+            # would look like congestion to libutp, so the I/O thread
+            # sends it once the socket is writable again.
+            self.__send_buf.append((data, addr))
+            self.wakeup()
+        except OSError as e:
+            logger.error('Error sending to {}:{}: {}'.format(
+                addr[0], addr[1], e))
+
+    def __flush(self):
+        # with the lock held
+        send_buf = self.__send_buf
+        while send_buf:
+            data, addr = send_buf[0]
+            try:
+                self.udp_sock.sendto(data, addr)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                logger.error('Error sending to {}:{}: {}'.format(
+                    addr[0], addr[1], e))
+            send_buf.popleft()
+
+    def __state_change_cb(self, cb, ctx, sock, state):
+        s = self.sockets.get(sock)
+        if s is not None:
+            s._state_changed(state)
+        if state == utp.UTP_STATE_DESTROYING:
+            self.sockets.pop(sock, None)
+
+    def __error_cb(self, cb, ctx, sock, error_code):
+        s = self.sockets.get(sock)
+        if s is not None:
+            s._error(error_code)
+
+    def __read_cb(self, cb, ctx, sock, args):
+        s = self.sockets.get(sock)
+        if s is not None:
+            s._data_received(args.buf, args.len)
+
+    def __get_read_buffer_size_cb(self, cb, ctx, sock):
+        s = self.sockets.get(sock)
+        return s._buffered if s is not None else 0
+
+    def __firewall_cb(self, cb, ctx, addr):
+        # non-zero rejects the connection
+        if self.listener is None or not self.listener._accepting():
+            return 1
+        return 0
+
+    def __accept_cb(self, cb, ctx, sock, addr):
+        s = UtpSocket(self, _sock=sock, _peername=addr)
+        self.listener._accepted(s, addr)
+
+    def __run(self):
+        buf = bytearray(RECV_BUF_SIZE)
+        cbuf = (ctypes.c_char * len(buf)).from_buffer(buf)
+        selector = selectors.DefaultSelector()
+        selector.register(self.udp_sock, selectors.EVENT_READ)
+        selector.register(self.__wakeup_r, selectors.EVENT_READ)
+        next_check = time.monotonic() + TIMEOUT_INTERVAL
+        writing = False
+
+        while not (self.closing and not self.sockets):
+            if writing != bool(self.__send_buf):
+                writing = not writing
+                selector.modify(self.udp_sock, selectors.EVENT_READ |
+                                (selectors.EVENT_WRITE if writing else 0))
+            timeout = max(next_check - time.monotonic(), 0)
+            for key, events in selector.select(timeout):
+                if key.fileobj is self.__wakeup_r:
+                    try:
+                        self.__wakeup_r.recv(4096)
+                    except BlockingIOError:
+                        pass
+                    continue
+                if events & selectors.EVENT_WRITE:
+                    with self.lock:
+                        self.__flush()
+                if not events & selectors.EVENT_READ:
+                    continue
+                with self.lock:
+                    while True:
+                        try:
+                            n, addr = self.udp_sock.recvfrom_into(buf)
+                        except BlockingIOError:
+                            break
+                        except OSError as e:
+                            logger.error('Error reading from UDP socket: '
+                                         '{}'.format(e))
+                            break
+                        utp.utp_process_udp(self.ctx, cbuf, addr, n)
+                    utp.utp_issue_deferred_acks(self.ctx)
+
+            if time.monotonic() >= next_check:
+                with self.lock:
+                    utp.utp_check_timeouts(self.ctx)
+                next_check = time.monotonic() + TIMEOUT_INTERVAL
+
+        selector.close()
+        with self.lock:
+            utp.utp_destroy(self.ctx)
+            self.ctx = None
+        self.udp_sock.close()
+        self.__wakeup_r.close()
+        self.__wakeup_w.close()
+
+    def wakeup(self):
+        try:
+            self.__wakeup_w.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass
+
+    def close(self):
+        with self.lock:
+            self.closing = True
+        self.wakeup()
+
+class UtpSocket:
+    """A blocking, socket-like uTP connection, for use from ordinary
+    threads. Without a context, the socket gets a context (and I/O
+    thread) of its own, which is closed with it."""
+
+    def __init__(self, context=None, rcvbuf=RCVBUF_SIZE, _sock=None,
+                 _peername=None):
+        self.__owns_context = context is None
+        if context is None:
+            context = Context()
+        self.__context = context
+        self.__cond = threading.Condition(context.lock)
+        self.__recv_buf = RingBuffer(rcvbuf)
+        self.__timeout = None
+        self.__sock = _sock
+        self.__peername = _peername
+        self.__connected = _sock is not None
+        self.__writable = self.__connected
+        self.__eof = False
+        self.__closed = False
+        self.__destroyed = False
+        self.__error = None
+        if _sock is not None:
+            context.sockets[_sock] = self
+
+    # the following are called by the context, with the lock held
+
+    @property
+    def _buffered(self):
+        return self.__recv_buf.len
+
+    def _state_changed(self, state):
+        if state in (utp.UTP_STATE_CONNECT, utp.UTP_STATE_WRITABLE):
+            self.__connected = True
+            self.__writable = True
+        elif state == utp.UTP_STATE_EOF:
+            self.__eof = True
+        elif state == utp.UTP_STATE_DESTROYING:
+            self.__eof = True
+            self.__destroyed = True
+        self.__cond.notify_all()
+
+    def _error(self, error_code):
+        self.__error = errors.get(error_code, ConnectionError)(
+            'UTP error: {}'.format(error_code))
+        self.__cond.notify_all()
+
+    def _data_received(self, ptr, n):
+        self.__recv_buf.write_from(ptr, n)
+        self.__cond.notify_all()
+
+    def __wait(self, predicate):
+        # with the lock held; raises on timeout
+        if not self.__cond.wait_for(predicate, self.__timeout):
+            if self.__timeout == 0:
+                raise BlockingIOError('Operation would block.')
+            raise socket.timeout('timed out')
+
+    def __check(self):
+        if self.__error is not None:
+            raise self.__error
+        if self.__closed:
+            raise OSError('Socket is closed.')
+
+    def settimeout(self, timeout):
+        """None blocks indefinitely, 0 makes every call non-blocking."""
+        self.__timeout = timeout
+
+    def gettimeout(self):
+        return self.__timeout
+
+    def connect(self, address):
+        # resolve before taking the lock, which the I/O thread needs
+        addr = (socket.gethostbyname(address[0]), address[1])
+        with self.__cond:
+            if self.__sock is not None:
+                raise RuntimeError('Socket is already connected.')
+            self.__check()
+            self.__sock = utp.utp_create_socket(self.__context.ctx)
+            self.__context.sockets[self.__sock] = self
+            self.__peername = addr
+            if utp.utp_connect(self.__sock, addr) != 0:
+                raise RuntimeError('Could not establish UTP connection.')
+            self.__wait(lambda: self.__connected or
+                        self.__error is not None or self.__destroyed)
+            self.__check()
+            if not self.__connected:
+                raise ConnectionError('Connection failed.')
+
+    def send(self, data):
+        """Send as much of data as libutp will take, waiting until it
+        takes some. Returns the number of bytes sent."""
+        view = memoryview(data).cast('B')
+        if view.readonly and type(data) is not bytes:
+            data = bytes(view)
+        elif not view.readonly:
+            data = view
+        if not len(view):
+            # libutp takes nothing, which would look like a full buffer
+            return 0
+        with self.__cond:
+            while True:
+                self.__check()
+                if self.__eof and self.__destroyed:
+                    raise BrokenPipeError('Connection closed.')
+                if self.__writable:
+                    n = utp.utp_write(self.__sock, data)
+                    if n < len(view):
+                        # libutp's buffer is full; it says when it
+                        # isn't anymore with UTP_STATE_WRITABLE
+                        self.__writable = False
+                    if n:
+                        return n
+                self.__wait(lambda: self.__writable or
+                            self.__error is not None or self.__destroyed)
+
+    def sendall(self, data):
+        view = memoryview(data).cast('B')
+        if view.readonly and type(data) is not bytes:
+            data = bytes(view)
+        elif not view.readonly:
+            data = view
+        offset = 0
+        with self.__cond:
+            while offset < len(data):
+                self.__check()
+                if self.__destroyed:
+                    raise BrokenPipeError('Connection closed.')
+                if self.__writable:
+                    n = utp.utp_write(self.__sock, data, offset)
+                    offset += n
+                    if offset == len(data):
+                        break
+                    self.__writable = False
+                self.__wait(lambda: self.__writable or
+                            self.__error is not None or self.__destroyed)
+
+    def recv_into(self, buffer, nbytes=0):
+        """Read up to nbytes (or len(buffer)) bytes into buffer. Returns
+        0 once the peer has closed the connection."""
+        view = memoryview(buffer).cast('B')
+        if nbytes:
+            view = view[:nbytes]
+        with self.__cond:
+            self.__wait(lambda: self.__recv_buf.len or self.__eof or
+                        self.__error is not None or self.__closed)
+            if not self.__recv_buf.len:
+                self.__check()
+                return 0
+            n = self.__recv_buf.read_into(view)
+            if not self.__destroyed:
+                # let libutp open the receive window again
+                utp.utp_read_drained(self.__sock)
+            return n
+
+    def recv(self, bufsize):
+        buf = bytearray(bufsize)
+        n = self.recv_into(buf)
+        del buf[n:]
+        return bytes(buf)
+
+    def getpeername(self):
+        if self.__sock is None:
+            raise OSError('Socket is not connected.')
+        return self.__peername
+
+    def close(self):
+        with self.__cond:
+            if self.__closed:
+                return
+            self.__closed = True
+            if self.__sock is not None and not self.__destroyed:
+                utp.utp_close(self.__sock)
+            else:
+                self.__context.sockets.pop(self.__sock, None)
+            self.__cond.notify_all()
+        if self.__owns_context:
+            self.__context.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class UtpListener:
+    """Accepts uTP connections on the given address. Accepted sockets
+    share the listener's context; it is only destroyed once the
+    listener and all of them are closed."""
+
+    def __init__(self, address, backlog=128):
+        self.__context = Context(address)
+        self.__cond = threading.Condition(self.__context.lock)
+        self.__pending = deque()
+        self.__backlog = backlog
+        self.__timeout = None
+        self.__closed = False
+        self.__context.listener = self
+
+    # called by the context, with the lock held
+
+    def _accepting(self):
+        return not self.__closed and len(self.__pending) < self.__backlog
+
+    def _accepted(self, sock, addr):
+        self.__pending.append((sock, addr))
+        self.__cond.notify_all()
+
+    def getsockname(self):
+        return self.__context.udp_sock.getsockname()
+
+    def settimeout(self, timeout):
+        self.__timeout = timeout
+
+    def accept(self):
+        """Wait for a connection and return (UtpSocket, address)."""
+        with self.__cond:
+            ok = self.__cond.wait_for(
+                lambda: self.__pending or self.__closed, self.__timeout)
+            if self.__closed:
+                raise OSError('Listener is closed.')
+            if not ok:
+                if self.__timeout == 0:
+                    raise BlockingIOError('Operation would block.')
+                raise socket.timeout('timed out')
+            return self.__pending.popleft()
+
+    def close(self):
+        with self.__cond:
+            if self.__closed:
+                return
+            self.__closed = True
+            pending = list(self.__pending)
+            self.__pending.clear()
+            self.__cond.notify_all()
+        for sock, addr in pending:
+            sock.close()
+        self.__context.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
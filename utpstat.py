@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+import argparse
+import sys
+
+def percentile(values, p):
+    # values must be sorted
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def read_telemetry(f):
+    records = []
+    for line in f:
+        line = line.strip()
+        if not line:
+            continue
+        time, kind, value = line.split()
+        records.append((float(time), kind, int(value)))
+    return records
+
+def summarize(records, interval=1.0):
+    delays = sorted(value for time, kind, value in records if kind == 'delay')
+    sent = [(time, value) for time, kind, value in records if kind == 'sent']
+    retransmits = [value for time, kind, value in records
+                   if kind == 'retransmit']
+
+    if records:
+        start = records[0][0]
+        duration = records[-1][0] - start
+    else:
+        start = 0
+        duration = 0
+
+    # Bytes sent per interval are the closest thing we have to the
+    # congestion window, as seen from outside libutp.
+    rates = {}
+    for time, value in sent:
+        bucket = int((time - start) / interval)
+        rates[bucket] = rates.get(bucket, 0) + value
+    rates = sorted(v / interval for v in rates.values())
+
+    total_sent = sum(value for time, value in sent)
+    return {
+        'duration': duration,
+        'delay_samples': len(delays),
+        'delay_min': delays[0] if delays else 0,
+        'delay_avg': sum(delays) / len(delays) if delays else 0,
+        'delay_p50': percentile(delays, 50),
+        'delay_p95': percentile(delays, 95),
+        'delay_max': delays[-1] if delays else 0,
+        'datagrams_sent': len(sent),
+        'bytes_sent': total_sent,
+        'rate_avg': total_sent / duration if duration else 0,
+        'rate_p50': percentile(rates, 50),
+        'rate_max': rates[-1] if rates else 0,
+        'retransmits': len(retransmits),
+        'retransmitted_bytes': sum(retransmits),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Summarize telemetry dumped by aioutp.Telemetry.dump.')
+
+    parser.add_argument('file', nargs='?',
+                        help='Telemetry file. Defaults to standard input.')
+    parser.add_argument('--interval', '-i', type=float, default=1.0,
+                        help='Interval over which send rates are '
+                        'calculated, in seconds. Defaults to 1.')
+
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file) as f:
+            records = read_telemetry(f)
+    else:
+        records = read_telemetry(sys.stdin)
+
+    s = summarize(records, args.interval)
+    print('Duration:      {duration:.3f}s'.format(**s))
+    print('Delay samples: {delay_samples} (min {delay_min} ms, '
+          'avg {delay_avg:.1f} ms, p50 {delay_p50} ms, p95 {delay_p95} ms, '
+          'max {delay_max} ms)'.format(**s))
+    print('Sent:          {bytes_sent} bytes in {datagrams_sent} datagrams'
+          .format(**s))
+    print('Send rate:     avg {rate_avg:.0f} B/s, p50 {rate_p50:.0f} B/s, '
+          'max {rate_max:.0f} B/s'.format(**s))
+    print('Retransmits:   {retransmits} ({retransmitted_bytes} bytes)'
+          .format(**s))
+
+if __name__ == '__main__':
+    main()
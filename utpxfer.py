@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import logging
+import os
+import struct
+import sys
+import time
+import uuid
+import aioutp
+
+# Each stream of a transfer starts with a STREAM_HEADER followed by the
+# file name, then carries any number of chunks, each a CHUNK_HEADER
+# followed by the data, and ends with an empty chunk. Chunks are handed
+# out to the streams as they become free, so faster streams carry more
+# of the file. The receiver answers the empty chunk with an ACK of the
+# number of bytes it got on the stream.
+MAGIC = b'UTPX'
+
+# magic, transfer id, file size, number of streams, file name length
+STREAM_HEADER = struct.Struct('<4s16sQHH')
+
+# offset, length
+CHUNK_HEADER = struct.Struct('<QI')
+
+# bytes received on the stream
+ACK = struct.Struct('<Q')
+
+CHUNK_SIZE = 1024 * 1024
+
+# size of the reads from the connection on the receiving side
+READ_SIZE = 256 * 1024
+
+# seconds to wait for a connection to finish closing once the receiver
+# has acknowledged everything sent on it
+CLOSE_TIMEOUT = 10
+
+logger = logging.getLogger('utpxfer')
+
+async def send_stream(f, size, offsets, chunk_size, header, host, port,
+                      **kwargs):
+    reader, writer = await aioutp.open_connection(host, port, **kwargs)
+    writer.write(header)
+    sent = 0
+    # offsets is shared between all the streams of a transfer
+    for offset in offsets:
+        length = min(chunk_size, size - offset)
+        data = os.pread(f, length, offset)
+        writer.write(CHUNK_HEADER.pack(offset, len(data)))
+        writer.write(data)
+        sent += len(data)
+        await writer.drain()
+    writer.write(CHUNK_HEADER.pack(0, 0))
+    try:
+        received, = ACK.unpack(await reader.readexactly(ACK.size))
+        if received != sent:
+            raise RuntimeError('Receiver got {} of {} bytes.'.format(
+                received, sent))
+    finally:
+        writer.close()
+    try:
+        await asyncio.wait_for(writer.transport.wait_closed(), CLOSE_TIMEOUT)
+    except asyncio.TimeoutError:
+        # everything was acknowledged; only the FIN is missing
+        logger.warning('Connection did not close within {}s.'.format(
+            CLOSE_TIMEOUT))
+    return sent
+
+async def send_file(path, host, port, streams=4, chunk_size=CHUNK_SIZE,
+                    **kwargs):
+    """Send the file at path to a receiver at host:port, striped across
+    the given number of connections. Any extra keyword arguments are
+    passed on to aioutp.open_connection. Returns a dict of
+    statistics."""
+    size = os.path.getsize(path)
+    name = os.path.basename(path).encode('utf-8')
+    transfer_id = uuid.uuid4().bytes
+    header = STREAM_HEADER.pack(MAGIC, transfer_id, size, streams,
+                                len(name)) + name
+
+    f = os.open(path, os.O_RDONLY)
+    try:
+        offsets = iter(range(0, size, chunk_size))
+        start = time.monotonic()
+        sent = await asyncio.gather(*[
+            send_stream(f, size, offsets, chunk_size, header, host, port,
+                        **kwargs)
+            for i in range(streams)])
+        elapsed = time.monotonic() - start
+    finally:
+        os.close(f)
+
+    return {
+        'transfer_id': uuid.UUID(bytes=transfer_id).hex,
+        'bytes': sum(sent),
+        'streams': sent,
+        'elapsed': elapsed,
+    }
+
+class Transfer:
+    def __init__(self, transfer_id, path, size, streams):
+        self.transfer_id = transfer_id
+        self.path = path
+        self.size = size
+        self.streams = streams
+        self.received = 0
+        self.finished = 0
+        self.failed = False
+        self.start = time.monotonic()
+
+        self.part_path = path + '.part'
+        self.fd = os.open(self.part_path,
+                          os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        if size:
+            # preallocate, so that out of order writes don't fragment
+            # the file
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(self.fd, 0, size)
+            else:
+                os.ftruncate(self.fd, size)
+
+    def write(self, data, offset):
+        os.pwrite(self.fd, data, offset)
+        self.received += len(data)
+
+    @property
+    def complete(self):
+        return self.finished == self.streams and self.received == self.size
+
+class Receiver:
+    """Receives transfers sent by send_file into directory. Use
+    handle_stream as the client_connected_cb of aioutp.start_server,
+    or call start_receiver. on_complete, if given, is called with each
+    Transfer once its file is complete."""
+
+    def __init__(self, directory, on_complete=None):
+        self.directory = directory
+        self.on_complete = on_complete
+        self.transfers = {}
+
+    def __get_transfer(self, transfer_id, name, size, streams):
+        transfer = self.transfers.get(transfer_id)
+        if transfer is None:
+            # never trust the sender with anything but a file name
+            name = os.path.basename(name) or uuid.UUID(bytes=transfer_id).hex
+            path = os.path.join(self.directory, name)
+            transfer = Transfer(transfer_id, path, size, streams)
+            self.transfers[transfer_id] = transfer
+            logger.info('Receiving {} ({} bytes) over {} streams.'.format(
+                name, size, streams))
+        return transfer
+
+    async def handle_stream(self, reader, writer):
+        transfer = None
+        received = 0
+        try:
+            magic, transfer_id, size, streams, name_len = \
+                STREAM_HEADER.unpack(
+                    await reader.readexactly(STREAM_HEADER.size))
+            if magic != MAGIC:
+                raise RuntimeError('Not a transfer stream.')
+            name = (await reader.readexactly(name_len)).decode('utf-8')
+            transfer = self.__get_transfer(transfer_id, name, size, streams)
+
+            while True:
+                offset, length = CHUNK_HEADER.unpack(
+                    await reader.readexactly(CHUNK_HEADER.size))
+                if length == 0:
+                    writer.write(ACK.pack(received))
+                    break
+                if offset + length > transfer.size:
+                    raise RuntimeError('Chunk out of range.')
+                # write the chunk as it arrives instead of collecting it
+                while length:
+                    data = await reader.read(min(length, READ_SIZE))
+                    if not data:
+                        raise RuntimeError('Stream ended inside a chunk.')
+                    transfer.write(data, offset)
+                    received += len(data)
+                    offset += len(data)
+                    length -= len(data)
+        except (RuntimeError, OSError, asyncio.IncompleteReadError) as e:
+            logger.error('Transfer stream failed: {}'.format(e))
+            if transfer is not None:
+                transfer.failed = True
+        finally:
+            writer.close()
+
+        if transfer is not None:
+            transfer.finished += 1
+            if transfer.finished == transfer.streams:
+                self.__finish(transfer)
+
+    def __finish(self, transfer):
+        del self.transfers[transfer.transfer_id]
+        os.close(transfer.fd)
+        if transfer.failed or not transfer.complete:
+            logger.error('Transfer of {} incomplete: got {} of {} bytes.'
+                         .format(transfer.path, transfer.received,
+                                 transfer.size))
+            return
+        os.rename(transfer.part_path, transfer.path)
+        elapsed = time.monotonic() - transfer.start
+        logger.info('Received {} ({} bytes) in {:.3f}s.'.format(
+            transfer.path, transfer.size, elapsed))
+        if self.on_complete is not None:
+            self.on_complete(transfer)
+
+async def start_receiver(directory, host=None, port=None, on_complete=None,
+                         **kwargs):
+    """Start a server receiving transfers into directory. Any extra
+    keyword arguments are passed on to aioutp.start_server. Returns
+    the Receiver and the server."""
+    receiver = Receiver(directory, on_complete)
+    server = await aioutp.start_server(receiver.handle_stream, host, port,
+                                       **kwargs)
+    return receiver, server
+
+async def receive(args):
+    await start_receiver(args.directory, args.bind_address, args.port,
+                         debug=args.debug)
+    # serve until interrupted
+    await asyncio.Event().wait()
+
+async def send(args):
+    stats = await send_file(args.file, args.dest_host, args.dest_port,
+                            args.streams, args.chunk_size, debug=args.debug)
+    elapsed = stats['elapsed']
+    print('Sent {} bytes over {} streams in {:.3f}s ({:.2f} MiB/s)'.format(
+        stats['bytes'], len(stats['streams']), elapsed,
+        stats['bytes'] / 2**20 / elapsed if elapsed else 0))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Transfer a file over several parallel uTP connections.')
+    parser.add_argument('--debug', '-d', action='store_true',
+                        help='Enable libutp debug logs.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    send_parser = subparsers.add_parser('send', help='Send a file.')
+    send_parser.add_argument('file', help='File to send.')
+    send_parser.add_argument('dest_host', metavar='DEST-HOST',
+                             help='Destination host.')
+    send_parser.add_argument('dest_port', metavar='DEST-PORT', type=int,
+                             help='Destination port.')
+    send_parser.add_argument('--streams', '-n', type=int, default=4,
+                             help='Number of parallel connections. '
+                             'Defaults to 4.')
+    send_parser.add_argument('--chunk-size', '-c', type=int,
+                             default=CHUNK_SIZE,
+                             help='Size of the chunks the file is split '
+                             'into, in bytes. Defaults to {}.'.format(
+                                 CHUNK_SIZE))
+
+    receive_parser = subparsers.add_parser(
+        'receive', help='Receive files until interrupted.')
+    receive_parser.add_argument('port', type=int, help='Port to listen on.')
+    receive_parser.add_argument('--bind', '-b', default='127.0.0.1',
+                                dest='bind_address',
+                                help='The IP address to bind to. Defaults '
+                                'to 127.0.0.1.')
+    receive_parser.add_argument('--directory', '-C', default='.',
+                                help='Directory to write the received files '
+                                'to. Defaults to the current directory.')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO,
+        format='%(asctime) -15s - %(levelname) -8s - %(message)s')
+
+    try:
+        if args.command == 'send':
+            asyncio.run(send(args))
+        else:
+            asyncio.run(receive(args))
+    except KeyboardInterrupt:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()